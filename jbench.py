@@ -0,0 +1,276 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of database, run on synthetic databases in a temporary folder.
+usage:
+  python jbench.py profiles [--docs N] [--blob-kb K]
+  python jbench.py zdict DATABASE [--samples N] [--store]
+  python jbench.py codecs DATABASE [--samples N]
+  python jbench.py tags [--tags N] [--legacy]
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+
+import jdb
+
+
+def synthetic_script(n, words=400):
+    """
+    @return json-format string which looks like a document saved by MainApp.
+    """
+    vocabulary = ['diary', 'note', 'python', 'sqlite', 'image', 'table', 'tag', 'search',
+                  'morning', 'evening', 'travel', 'book', 'music', 'code', 'family', '日记']
+    text = ' '.join(random.choice(vocabulary) for _ in range(words))
+    textual = {'text': 'note %d\n%s' % (n, text),
+               'font': {'family': 'Helvetica', 'size': 18},
+               'underline': ['1.0 1.4'],
+               'table': [{'pos': '2.0', 'specs': [[{'text': 'cell %d' % n}, {'text': 'value'}]]}]}
+    return json.dumps(textual)
+
+
+def synthetic_bulk(size):
+    # images are already compressed, so random bytes are close to them.
+    return b'jxd' + os.urandom(size) if size > 0 else b''
+
+
+def timed(func, *a):
+    start = time.perf_counter()
+    result = func(*a)
+    return time.perf_counter() - start, result
+
+
+def bench_profile(folder, profile, docs, blob_kb):
+    """
+    @return dict of results in milliseconds.
+    """
+    random.seed(0)
+    filename = os.path.join(folder, '%s.sqlite3' % profile)
+    db = jdb.DocBase.create_db(filename, profile)
+    day = datetime.date(2019, 1, 1)
+    # 1. save latency (each document has its own commit, like MainApp.save_)
+    insert = []
+    for i in range(docs):
+        record = jdb.DBRecordDoc('doc %d' % i, date=day + datetime.timedelta(days=i))
+        record.script = synthetic_script(i)
+        record.bulk = synthetic_bulk(blob_kb * 1024 if i % 10 == 0 else 0)
+        elapsed, _ = timed(db.insert_doc, record)
+        insert.append(elapsed)
+    # 2. update latency of text only
+    update = []
+    for sn in range(1, docs + 1, max(docs // 50, 1)):
+        record = jdb.DBRecordDoc('doc', sn=sn)
+        record.script = synthetic_script(sn + docs)
+        elapsed, _ = timed(db.update_doc, record)
+        update.append(elapsed)
+    db.close()
+    # 3. cold open, and reading large blobs
+    elapsed_open, db = timed(jdb.DocBase, filename, profile)
+    reads = [timed(db.read_doc, sn)[0] for sn in range(1, docs + 1, 10)]
+    # 4. a search and its first page
+    def search():
+        cursor = db.query_doc(8, content=['python', 'music'])
+        return cursor.count(), cursor.page(0)
+    elapsed_search, _ = timed(search)
+    db.close()
+    ms = 1000.0
+    return {'insert avg': sum(insert) / len(insert) * ms,
+            'insert max': max(insert) * ms,
+            'update avg': sum(update) / len(update) * ms,
+            'open': elapsed_open * ms,
+            'blob read avg': sum(reads) / len(reads) * ms,
+            'search': elapsed_search * ms,
+            'file MB': os.path.getsize(filename) / (1024.0 * 1024.0)}
+
+
+def bench_profiles(args):
+    folder = tempfile.mkdtemp(prefix='bitty-bench-')
+    try:
+        names = args.profiles.split(',') if args.profiles else sorted(jdb.DocBase.profiles)
+        results = [(i, bench_profile(folder, i, args.docs, args.blob_kb)) for i in names]
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    columns = list(results[0][1].keys())
+    print('%-10s' % 'profile' + ''.join('%15s' % i for i in columns))
+    for name, result in results:
+        print('%-10s' % name + ''.join('%15.2f' % result[i] for i in columns))
+
+
+def bench_zdict(args):
+    """
+    Measure a preset dictionary trained from an existing database: half of sampled
+    documents train it, the other half are compressed with and without it.
+    """
+    db = jdb.DocBase(args.database)
+    samples = db.sample_texts_(args.samples)
+    if len(samples) < 2:
+        print('Too few documents.')
+        return
+    training, testing = samples[::2], samples[1::2]
+    zdict = jdb.DocBase.build_zdict_(training)
+    plain, zipped, dict_zipped = 0, [], []
+    for i in testing:
+        plain += len(i)
+        zipped.append(zlib.compress(i, 6))
+        c = zlib.compressobj(6, zdict=zdict)
+        dict_zipped.append(c.compress(i) + c.flush())
+    def decode_all():
+        for i in zipped:
+            zlib.decompress(i)
+    def decode_all_with_dict():
+        for i in dict_zipped:
+            d = zlib.decompressobj(zdict=zdict)
+            d.decompress(i)
+            d.flush()
+    t1, _ = timed(decode_all)
+    t2, _ = timed(decode_all_with_dict)
+    size1 = sum(len(i) for i in zipped)
+    size2 = sum(len(i) for i in dict_zipped) + 5 * len(dict_zipped)  # 5 bytes of codec header
+    print('documents: %d for training, %d for testing' % (len(training), len(testing)))
+    print('dictionary: %d bytes' % len(zdict))
+    print('%-12s%15s%15s%20s' % ('codec', 'bytes', 'ratio', 'decode us/doc'))
+    print('%-12s%15d%15.3f%20.1f' % ('none', plain, 1.0, 0))
+    print('%-12s%15d%15.3f%20.1f' % ('zlib', size1, size1 / float(plain), t1 / len(testing) * 1e6))
+    print('%-12s%15d%15.3f%20.1f' % ('zlib+zdict', size2, size2 / float(plain), t2 / len(testing) * 1e6))
+    if args.store:
+        sn = db.train_zdict(samples)
+        print('dictionary #%d is trained from all samples and stored.' % sn)
+    db.close()
+
+
+def bench_codecs(args):
+    """
+    Compare every registered codec on sampled documents of a database, column by column.
+    """
+    db = jdb.DocBase(args.database)
+    cur = db._con.cursor()
+    cur.execute('SELECT text, bulk FROM content WHERE id IN (SELECT id FROM docs ORDER BY RANDOM() LIMIT ?)',
+                (args.samples,))
+    rows = [(db.decode_(t), db.decode_(b)) for t, b in cur.fetchall()]
+    has_zdict = db.current_zdict_()[1] is not None
+    print('%-8s%-10s%15s%15s%20s%20s' % ('column', 'codec', 'bytes', 'ratio', 'encode us/doc', 'decode us/doc'))
+    for index, column in enumerate(('text', 'bulk')):
+        values = [i[index] for i in rows if len(i[index]) > 0]
+        if len(values) == 0:
+            continue
+        plain = sum(len(i) for i in values)
+        for codec in sorted(jdb.Codec.registry.values(), key=lambda c: c.sn):
+            if codec.name == 'zdict' and not has_zdict:
+                continue
+            t1, encoded = timed(lambda: [codec.encode(i, db) for i in values])
+            t2, _ = timed(lambda: [codec.decode(i, db) for i in encoded])
+            size = sum(len(i) for i in encoded)
+            print('%-8s%-10s%15d%15.3f%20.1f%20.1f' % (column, codec.name, size, size / float(plain),
+                                                     t1 / len(values) * 1e6, t2 / len(values) * 1e6))
+        chosen = collections.Counter(jdb.DocBase.codec_policy.choose(column, i, False, has_zdict) for i in values)
+        print('%-8spolicy picks (hot): %s' % (column, dict(chosen)))
+    db.close()
+
+
+def synthetic_tags(num):
+    """
+    @return array of tuple(id, name, base), a random tree whose rows are shuffled, so that
+            a child may come before its parent.
+    """
+    ids = list(range(1, num + 1))
+    random.shuffle(ids)  # ids[i] is the i-th tag in creation order
+    rows = []
+    for i, sn in enumerate(ids):
+        base = 0 if i < 10 else ids[random.randrange(max(i - 50, 0), i)]  # bushy and deep
+        rows.append((sn, 'tag %d' % sn, base))
+    return rows
+
+
+def legacy_organize(tags, tag):
+    """
+    the former DBRecordTag.forest_organize: search the forest recursively for parent.
+    """
+    for i in tags:
+        if i.sn == tag.parent:
+            i.add_child(tag)
+            return True
+        if legacy_organize(i.children, tag):
+            return True
+    return False
+
+
+def legacy_load_tags(rows):
+    """
+    the former algorithm: organize every tag into the forest one by one.
+    """
+    tags = [jdb.DBRecordTag(n, b, s) for s, n, b in sorted(rows)]
+    for tag in tags[:]:
+        if tag.parent != 0 and legacy_organize(tags, tag):
+            tags.remove(tag)
+    return tags
+
+
+def bench_tags(args):
+    random.seed(0)
+    rows = synthetic_tags(args.tags)
+    folder = tempfile.mkdtemp(prefix='bitty-bench-')
+    try:
+        filename = os.path.join(folder, 'tags.sqlite3')
+        jdb.DocBase.create_db(filename).close()
+        con = sqlite3.connect(filename)
+        con.executemany('INSERT INTO tags (id, name, base) VALUES(?,?,?)', rows)
+        con.commit()
+        con.close()
+        elapsed1, db = timed(jdb.DocBase, filename)  # intervals are numbered and written
+        db.close()
+        elapsed2, db = timed(jdb.DocBase, filename)
+        elapsed3, tags = timed(db.load_all_tags)
+        depth = max(len(i.all_family()) for i in tags)
+        db.close()
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    print('tags: %d, roots: %d, largest tree: %d' % (len(rows), len(tags), depth))
+    print('first open (numbering): %10.1f ms' % (elapsed1 * 1000))
+    print('open:                   %10.1f ms' % (elapsed2 * 1000))
+    print('load_all_tags:          %10.1f ms' % (elapsed3 * 1000))
+    if args.legacy:
+        # former one can't handle a child before its parent, so rows are in tree order.
+        ordered, renumber = [], {}
+        for sn, name, base in rows:  # in creation order
+            renumber[sn] = len(ordered) + 1
+            ordered.append((renumber[sn], name, renumber.get(base, 0)))
+        elapsed4, _ = timed(legacy_load_tags, ordered)
+        print('former load_all_tags:   %10.1f ms' % (elapsed4 * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmarks of bitty database')
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('profiles', help='compare storage profiles (times in ms)')
+    cmd.add_argument('--docs', type=int, default=500, help='number of documents')
+    cmd.add_argument('--blob-kb', type=int, default=2048, help='image size of every 10th document')
+    cmd.add_argument('--profiles', default='', help='comma separated names, default: all')
+    cmd.set_defaults(func=bench_profiles)
+    cmd = commands.add_parser('zdict', help='measure preset dictionary compression of a database')
+    cmd.add_argument('database', help='filename of database')
+    cmd.add_argument('--samples', type=int, default=jdb.DocBase.ZDICT_SAMPLES, help='number of sampled documents')
+    cmd.add_argument('--store', action='store_true', help='store the dictionary for new text')
+    cmd.set_defaults(func=bench_zdict)
+    cmd = commands.add_parser('codecs', help='compare codecs on documents of a database')
+    cmd.add_argument('database', help='filename of database')
+    cmd.add_argument('--samples', type=int, default=200, help='number of sampled documents')
+    cmd.set_defaults(func=bench_codecs)
+    cmd = commands.add_parser('tags', help='measure loading of a large tag forest')
+    cmd.add_argument('--tags', type=int, default=10000, help='number of tags')
+    cmd.add_argument('--legacy', action='store_true', help='also measure the former algorithm (slow)')
+    cmd.set_defaults(func=bench_tags)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        args.func(args)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Maintenance commands of database, which can run while MainApp has it open.
+usage:
+  python jcli.py reencode DATABASE [--archive-days N] [--hot CODEC] [--archival CODEC]
+  python jcli.py diff DATABASE ANOTHER
+  python jcli.py sync DATABASE ANOTHER [--prefer this|that] [--batch N]
+  python jcli.py zdict DATABASE [--samples N]
+The first sync of two databases has nothing remembered to compare with: a document on
+one side only is copied to the other (a deletion comes back), and a document which
+differs on both sides is a conflict. To sync a copied file, run sync right after copying.
+"""
+
+import argparse
+import sys
+
+import jdb
+
+
+def cmd_reencode(args):
+    for name in (args.hot, args.archival):
+        jdb.Codec.find(name)  # fail early on unknown codec
+    db = jdb.DocBase(args.database)
+    policy = jdb.CodecPolicy(hot=args.hot, archival=args.archival)
+    def progress(last, num):
+        print('document #%d visited, %d re-encoded' % (last, num))
+    num = db.reencode(args.archive_days, policy, args.batch, progress)
+    db.close()
+    if num < 0:
+        print('Failed.')
+    else:
+        print('Done: %d documents re-encoded.' % num)
+
+
+def cmd_diff(args):
+    """
+    print documents only in the first database as "< id title", and the ones only in
+    the second as "> id title". Exit status is 1 if they differ, 2 on trouble, like diff.
+    """
+    db = jdb.DocBase(args.database)
+    try:
+        mine, theirs = db.compare_docs(args.another)
+    except Exception as e:
+        print('Failed: %s' % e)
+        return 2
+    finally:
+        db.close()
+    for sn, title in mine:
+        print('< %d %s' % (sn, title))
+    for sn, title in theirs:
+        print('> %d %s' % (sn, title))
+    return 1 if len(mine) + len(theirs) > 0 else 0
+
+
+def cmd_sync(args):
+    this, that = jdb.DocBase(args.database), jdb.DocBase(args.another, jdb.DocBase.FOREIGN_PROFILE)
+    def progress(done, total):
+        print('%d/%d' % (done, total))
+    result = jdb.DocSync(this, that, args.prefer, args.batch, progress).run()
+    this.close()
+    that.close()
+    if 'error' in result:
+        print('Failed: %s' % result['error'])
+        return 2
+    print('pushed: %d, pulled: %d, deleted: %d' % (result['pushed'], result['pulled'], result['deleted']))
+    for uid, title in result['conflicts']:
+        print('conflict: %s %s' % (uid, title))
+    return 1 if len(result['conflicts']) > 0 else 0
+
+
+def cmd_zdict(args):
+    """
+    train a new preset dictionary of zlib from current documents, for new text since now.
+    The first one is trained automatically when there are enough documents.
+    """
+    db = jdb.DocBase(args.database)
+    sn = db.train_zdict(db.sample_texts_(args.samples))
+    db.close()
+    if sn == 0:
+        print('Failed.')
+        return 2
+    print('Done: dictionary #%d.' % sn)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='maintenance of bitty database')
+    commands = parser.add_subparsers(dest='command')
+    cmd = commands.add_parser('reencode', help='encode stored documents again by codec policy')
+    cmd.add_argument('database', help='filename of database')
+    cmd.add_argument('--archive-days', type=int, default=jdb.DocBase.archive_days,
+                     help='documents not modified in so many days are archival')
+    cmd.add_argument('--hot', default='zlib-1', help='codec of recent documents')
+    cmd.add_argument('--archival', default='lzma', help='codec of archival documents')
+    cmd.add_argument('--batch', type=int, default=64, help='documents per transaction')
+    cmd.set_defaults(func=cmd_reencode)
+    cmd = commands.add_parser('diff', help='list documents which are not in both databases')
+    cmd.add_argument('database', help='filename of database')
+    cmd.add_argument('another', help='filename of another database')
+    cmd.set_defaults(func=cmd_diff)
+    cmd = commands.add_parser('sync', help='two-way sync of databases')
+    cmd.add_argument('database', help='filename of database ("this")')
+    cmd.add_argument('another', help='filename of another database ("that")')
+    cmd.add_argument('--prefer', choices=['this', 'that'], default=None,
+                     help='side which wins a conflict, default: report and leave it')
+    cmd.add_argument('--batch', type=int, default=32, help='documents per transaction')
+    cmd.set_defaults(func=cmd_sync)
+    cmd = commands.add_parser('zdict', help='train a new preset dictionary for text')
+    cmd.add_argument('database', help='filename of database')
+    cmd.add_argument('--samples', type=int, default=jdb.DocBase.ZDICT_SAMPLES, help='number of sampled documents')
+    cmd.set_defaults(func=cmd_zdict)
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+    else:
+        sys.exit(args.func(args))
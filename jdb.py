@@ -7,21 +7,38 @@ Database related functions are organized here.
 
 import sqlite3
 import datetime
+import os
 import jex
 import zlib
 import hashlib
+import json
+import queue
+import threading
+import collections
+import itertools
+import re
+import struct
+import io
+import bz2
+import lzma
 
 if jex.isPython3():
     from enum import Enum
     class DocCols(Enum):
         id = 0
         title = 1
-        text = 2
-        bulk = 3
-        tags = 4
-        date = 5
-        date2 = 6
-        COUNT = 7
+        tags = 2
+        date = 3
+        date2 = 4
+        size = 5
+        COUNT = 6
+
+
+    class ContentCols(Enum):
+        id = 0
+        text = 1
+        bulk = 2
+        COUNT = 3
 
 
     class TagCols(Enum):
@@ -32,7 +49,8 @@ if jex.isPython3():
 
 
 else: # Python 2.x
-    DocCols = jex.enum2('id', 'title', 'text', 'bulk', 'tags', 'date', 'date2', 'COUNT')
+    DocCols = jex.enum2('id', 'title', 'tags', 'date', 'date2', 'size', 'COUNT')
+    ContentCols = jex.enum2('id', 'text', 'bulk', 'COUNT')
     TagCols = jex.enum2('id', 'name', 'base', 'COUNT')
 
 
@@ -46,6 +64,8 @@ class DBRecordTag(object):
         self._parent = base  # tags can be further divided into more detailed category,
         self._children = []  # e.g., creatures can be animals, birds, fishes, bacteria.
         self._sn = sn        # serial number
+        self._lft = 0        # interval of nested set: a tag's descendants are numbered
+        self._rgt = 0        # between its "lft" and "rgt" in pre-order walk of forest.
 
     @property
     def sn(self):
@@ -75,87 +95,50 @@ class DBRecordTag(object):
     def name(self, value):
         self._name = value
 
-    def add_child(self, tag):
-        if tag not in self._children:
-            self._children.append(tag)
-
-    def add_descendant(self, tag):
-        if tag.parent == self.sn:
-            self.add_child(tag)
-            return True
-        for i in self._children:
-            if i.add_descendant(tag):
-                return True
-        return False
-
-    def remove_descendant(self, tag):
-        if tag in self._children:
-            self._children.remove(tag)
-            return True
-        for i in self._children:
-            if i.remove_descendant(tag):
-                return True
-        return False
+    @property
+    def lft(self):
+        return self._lft
 
-    def find(self, sn):
-        if self._sn == sn:
-            return self
-        for i in self._children:
-            tag = i.find(sn)
-            if tag is not None:
-                return tag
-        return None
+    @lft.setter
+    def lft(self, value):
+        self._lft = value
 
-    def all_family(self):
-        family = [self._sn]
-        for i in self._children:
-            another = i.all_family()
-            family.extend(another)
-        return family
+    @property
+    def rgt(self):
+        return self._rgt
 
-    @staticmethod
-    def forest_organize(tags, tag):
-        for i in tags:
-            if i.sn == tag.parent:
-                i.add_child(tag)
-                return True
-            if DBRecordTag.forest_organize(i.children, tag):
-                return True
-        return False
+    @rgt.setter
+    def rgt(self, value):
+        self._rgt = value
 
-    @staticmethod
-    def forest_find(tags, sn):
-        for i in tags:
-            t = i.find(sn)
-            if t is not None:
-                return t
-        return None
+    def contains(self, tag):
+        """
+        @return True if tag is this one or its descendant. Two comparisons of interval.
+        """
+        return self._lft <= tag.lft and tag.rgt <= self._rgt
 
-    @staticmethod
-    def forest_delete(tags, tag):
-        for i in tags[:]:
-            if i == tag:
-                tags.remove(tag)
-                return True
-            if i.remove_descendant(tag):
-                return True
-        return False
+    def add_child(self, tag):
+        if tag not in self._children:
+            self._children.append(tag)
 
-    @staticmethod
-    def forest_add(tags, tag):
-        if tag.parent == 0:
-            tags.append(tag)
-            return True
-        for i in tags:
-            if i.add_descendant(tag):
-                return True
-        return False
+    def all_family(self):
+        """
+        @return array of sn, this tag and its descendants in pre-order.
+        @note: iterative, a deep tree won't exceed recursion limit of Python.
+        """
+        family = []
+        stack = [self]
+        while len(stack) > 0:
+            tag = stack.pop()
+            family.append(tag.sn)
+            stack.extend(reversed(tag.children))
+        return family
 
 
 class DBRecordDoc(object):
     """
-    @note: represents a database record in table "docs". For the table's columns, refer
-           to the definition of enum "DocCols".
+    @note: represents a database record in table "docs" and its content in table "content".
+           For the tables' columns, refer to the definition of enum "DocCols" and "ContentCols".
     """
     def __init__(self, title, text=None, bulk=None, tags=None, date=None, date2=None, sn=0, size=0):
         self._sn = sn
@@ -194,7 +177,7 @@ class DBRecordDoc(object):
             return
         self._text = value
         self._digests.update(text=digest)
-        self.mark_dirty_(DocCols.text)
+        self.mark_dirty_(ContentCols.text)
 
     @property
     def bulk(self):
@@ -207,7 +190,7 @@ class DBRecordDoc(object):
             return
         self._bulk = value
         self._digests.update(bulk=digest)
-        self.mark_dirty_(DocCols.bulk)
+        self.mark_dirty_(ContentCols.bulk)
 
     @property
     def date_created(self):
@@ -268,16 +251,75 @@ class DBRecordDoc(object):
     def mark_dirty_(self, col):
         self._dirty_flags.add(col)
 
-    def after_saving(self):
-        self._dirty_flags.clear()
+    def snapshot(self):
+        """
+        @return a copy with the same values and dirty fields, to be saved on another
+                thread (see DocWriter) while this one may be changed meanwhile. Apply
+                the result by after_saving on this thread.
+        """
+        copy = DBRecordDoc(self._title, self._text, self._bulk, list(self._tags),
+                           self._date, self._date2, self._sn, self._size)
+        copy._dirty_flags = set(self._dirty_flags)
+        copy._digests = dict(self._digests)
+        return copy
+
+    def after_saving(self, fields=None, copy=None):
+        """
+        @param fields: the saved fields. If a field is changed again during saving
+               (in background), it must be still dirty. None means all.
+        @param copy: the snapshot saved instead of this one. Its sn (given when it's
+               inserted) and digests are taken. A field whose value differs from the
+               copy's is changed during saving, so it stays dirty.
+        """
+        if copy is not None:
+            self._sn = copy.sn
+            if fields is not None:  # a field changed again is still dirty
+                fields = [i for i in fields if self.value_of_(i) == copy.value_of_(i)]
+            for key, col in (('text', ContentCols.text), ('bulk', ContentCols.bulk)):
+                if col not in self._dirty_flags and key in copy._digests:
+                    self._digests[key] = copy._digests[key]
+        if fields is None:
+            self._dirty_flags.clear()
+        else:
+            self._dirty_flags.difference_update(fields)
         # release their memory, and only keep their digests
         self._text = None
         self._bulk = None
 
+    def value_of_(self, field):
+        """
+        @return value of a field to be compared (text and images by digests).
+        """
+        if field == DocCols.title:
+            return self._title
+        if field == DocCols.tags:
+            return set(i.sn for i in self._tags)
+        if field == DocCols.date:
+            return self._date
+        if field == DocCols.date2:
+            return self._date2
+        if field == ContentCols.text:
+            return self._digests.get('text', None)
+        if field == ContentCols.bulk:
+            return self._digests.get('bulk', None)
+
     @property
     def unsaved_fields(self):
         return self._dirty_flags
 
+    def digest_of(self, field):
+        """
+        @param field: 'text' or 'bulk'.
+        @return md5 of its (decoded) value, None if unknown.
+        """
+        return self._digests.get(field, None)
+
+    def set_digest(self, field, digest):
+        """
+        @param digest: md5 of field's value, computed elsewhere (e.g., chunk by chunk).
+        """
+        self._digests[field] = digest
+
     def init_digest(self, **kw):
         for k, v in kw.items():
             if k == 'text':
@@ -285,130 +327,984 @@ class DBRecordDoc(object):
             self._digests.update({k: hashlib.md5(v).digest()})
 
 
+class DocCursor(object):
+    """
+    @note: represents the result of a search. Documents are fetched page by page on
+           demand, using keyset pagination on the sort key: a page is located by the
+           boundary of its neighbor page, rather than by skipping rows (OFFSET).
+    """
+    SORT_KEYS = ('id', 'date', 'date2', 'size')
+
+    def __init__(self, database, clauses, args, page_size):
+        """
+        @param database: DocBase object.
+        @param clauses: array of SQL conditions on table "docs".
+        @param args: parameters of above conditions.
+        """
+        self._db = database
+        self._where = ' AND '.join(clauses) if len(clauses) > 0 else '1'
+        self._args = list(args)
+        self._page_size = page_size
+        self._sort = 'id'
+        self._desc = False
+        self._total = None
+        self._bounds = {}  # page number --> tuple(key of first row, key of last row)
+
+    @property
+    def sort_key(self):
+        return self._sort
+
+    @property
+    def descending(self):
+        return self._desc
+
+    def sort(self, key, descending=False):
+        if key not in DocCursor.SORT_KEYS:
+            raise ValueError('Unknown sort key: %s' % key)
+        self._sort = key
+        self._desc = descending
+        self._bounds.clear()
+
+    def count(self):
+        if self._total is None:
+            self._total = self._db.count_doc_(self._where, self._args)
+        return self._total
+
+    def pages(self):
+        total = max(self.count(), 1)
+        return (total - 1) // self._page_size + 1
+
+    def refresh(self):
+        """
+        forget cached info after documents are inserted or deleted.
+        """
+        self._total = None
+        self._bounds.clear()
+
+    def page(self, n):
+        """
+        @return array of DBRecordDoc objects on page n (0-based).
+        """
+        if n == 0:
+            rows = self.fetch_(None, True, self._page_size)
+        elif n - 1 in self._bounds:
+            rows = self.fetch_(self._bounds[n - 1][1], True, self._page_size)
+        elif n + 1 in self._bounds:
+            rows = self.fetch_(self._bounds[n + 1][0], False, self._page_size)
+        elif n == self.pages() - 1:
+            rows = self.fetch_(None, False, self.count() - n * self._page_size)
+        else:  # random access is rare, just skip rows
+            rows = self.fetch_(None, True, self._page_size, n * self._page_size)
+        if len(rows) > 0:
+            self._bounds[n] = (self.key_(rows[0]), self.key_(rows[-1]))
+        return [self._db.record_from_row_(i) for i in rows]
+
+    def key_(self, row):
+        if self._sort == 'id':
+            return row[0],
+        return row[DocCursor.SORT_KEYS.index(self._sort) + 2], row[0]  # row: id, title, tags, ...
+
+    def fetch_(self, bound, forward, limit, offset=0):
+        """
+        @param bound: key of the row next to the page, or None for the first/last page.
+        @param forward: fetch rows after the bound (True) or before it (False).
+        """
+        columns = ('id',) if self._sort == 'id' else (self._sort, 'id')
+        ascending = forward != self._desc
+        where, args = self._where, list(self._args)
+        if bound is not None:
+            where = '%s AND (%s) %s (%s)' % (where, ','.join(columns), '>' if ascending else '<',
+                                           ','.join('?' * len(columns)))
+            args.extend(bound)
+        order = ','.join('%s %s' % (i, 'ASC' if ascending else 'DESC') for i in columns)
+        sql = 'SELECT id,title,tags,date,date2,size FROM docs WHERE %s ORDER BY %s LIMIT %d OFFSET %d' % (
+            where, order, max(limit, 0), offset)
+        rows = self._db.fetch_rows_(sql, args)
+        if not forward:
+            rows.reverse()
+        return rows
+
+
+class Codec(object):
+    """
+    @note: compression of a BLOB column. Encoded value starts with one byte, the id of
+           its codec, so that every value describes itself: codecs can be mixed in a
+           column and changed at any time, old values are still readable.
+    """
+    registry = {}  # id --> Codec
+
+    def __init__(self, sn, name, compress, decompress):
+        """
+        @param compress: function(bytes, DocBase) --> bytes
+        @param decompress: function(bytes-like, DocBase) --> bytes
+        """
+        self._sn = sn
+        self._name = name
+        self._compress = compress
+        self._decompress = decompress
+
+    @property
+    def sn(self):
+        return self._sn
+
+    @property
+    def name(self):
+        return self._name
+
+    def encode(self, data, database):
+        return bytes([self._sn]) + self._compress(data, database)
+
+    def decode(self, data, database):
+        return self._decompress(memoryview(data)[1:], database)
+
+    @staticmethod
+    def register(codec):
+        Codec.registry[codec.sn] = codec
+        return codec
+
+    @staticmethod
+    def find(name):
+        for codec in Codec.registry.values():
+            if codec.name == name:
+                return codec
+        raise KeyError('unknown codec: %s' % name)
+
+    @staticmethod
+    def of(data):
+        """
+        @return Codec of an encoded value, None if it's empty or in legacy format.
+        """
+        if data is None or len(data) == 0:
+            return None
+        return Codec.registry.get(data[0], None)
+
+
+def zdict_compress_(data, database):
+    """
+    @note: dictionary id (uint32, big-endian) goes before zlib stream.
+    """
+    sn, zdict = database.current_zdict_()
+    c = zlib.compressobj(6, zdict=zdict)
+    return struct.pack('>I', sn) + c.compress(data) + c.flush()
+
+
+def zdict_decompress_(data, database):
+    sn, = struct.unpack_from('>I', data)
+    d = zlib.decompressobj(zdict=database.zdict_(sn))
+    return d.decompress(data[4:]) + d.flush()
+
+
+# A bare zlib stream (the original format of "text") always starts with byte 0x78, and
+# a FilePile (the original format of "bulk") starts with b'jxd'. So ids of codecs avoid
+# 0x78 and 0x6A, and legacy values are still recognized. (FilePile v2 starts with b'jx2',
+# but it's never stored without a codec id.)
+Codec.register(Codec(0x00, 'none', lambda d, db: bytes(d), lambda d, db: bytes(d)))
+for level in range(1, 10):
+    Codec.register(Codec(level, 'zlib-%d' % level,
+                         lambda d, db, n=level: zlib.compress(d, n),
+                         lambda d, db: zlib.decompress(d)))
+Codec.register(Codec(0x42, 'bz2', lambda d, db: bz2.compress(d), lambda d, db: bz2.decompress(d)))
+Codec.register(Codec(0x44, 'zdict', zdict_compress_, zdict_decompress_))
+Codec.register(Codec(0x4C, 'lzma', lambda d, db: lzma.compress(d), lambda d, db: lzma.decompress(d)))
+
+
+class CodecPolicy(object):
+    """
+    @note: picks a codec for each value, by its column, its size and how well it
+           compresses. Recently modified documents are opened and saved often, so they
+           get a fast codec; archival ones get a dense one.
+    """
+    def __init__(self, hot='zlib-1', archival='lzma', tiny=64, small=16 * 1024, probe=64 * 1024, min_gain=0.1):
+        """
+        @param tiny: values shorter than it are not compressed, header costs more.
+        @param small: text shorter than it uses preset dictionary (if trained), and value
+               shorter than it never uses archival codec, whose header is large.
+        @param probe: bytes compressed to measure the ratio of a large value.
+        @param min_gain: a value is stored as it is if compression saves less than this.
+        """
+        self._hot = hot
+        self._archival = archival
+        self._tiny = tiny
+        self._small = small
+        self._probe = probe
+        self._min_gain = min_gain
+
+    def choose(self, column, data, archival=False, zdict=False):
+        """
+        @param column: 'text' or 'bulk'.
+        @param data: bytes to be encoded.
+        @param archival: True if the document is not modified for long.
+        @param zdict: True if database has a preset dictionary.
+        @return name of codec.
+        """
+        if len(data) < self._tiny:
+            return 'none'
+        if column == 'text' and zdict and len(data) < self._small:
+            return 'zdict'
+        # images are mostly compressed already (png, jpg), so measure before trying.
+        if column == 'bulk' or len(data) > self._probe:
+            probe = data[:self._probe]
+            if len(zlib.compress(probe, 1)) > len(probe) * (1.0 - self._min_gain):
+                return 'none'
+        if archival and len(data) >= self._small:
+            return self._archival
+        return self._hot
+
+
 class DocBase(object):
     """
     @note Database class, which is storing all documents.
     """
     date_support = {'detect_types': sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES}
-    find_words = None
-
-    def __init__(self, filename):
+    # since this schema version, "text" and "bulk" are stored in table "content".
+    content_split = 5
+    legacy_doc_cols = ['id', 'title', 'text', 'bulk', 'tags', 'date', 'date2']
+
+    # Storage profiles, applied to connection when database is opened. They trade
+    # durability for speed of saving (journal_mode, synchronous), and memory for speed
+    # of reading (cache_size in KiB if negative, mmap_size in bytes, temp_store).
+    # Run "python jbench.py" to compare them. WAL isn't reliable on network shares and
+    # leaves "-wal" and "-shm" files beside database, so it's never the default, and
+    # another database (a target of copying, comparing or syncing, often a backup on
+    # removable or network drive) is always opened with FOREIGN_PROFILE.
+    profiles = {
+        'classic': {'journal_mode': 'DELETE', 'synchronous': 'FULL', 'cache_size': -2000,
+                    'mmap_size': 0, 'temp_store': 'DEFAULT', 'busy_timeout': 5000},
+        'balanced': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'cache_size': -16384,
+                     'mmap_size': 256 * 1024 * 1024, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+        'fast': {'journal_mode': 'WAL', 'synchronous': 'OFF', 'cache_size': -65536,
+                 'mmap_size': 1024 * 1024 * 1024, 'temp_store': 'MEMORY', 'busy_timeout': 5000},
+    }
+    default_profile = 'classic'
+    # whether SQLite has trigram tokenizer, see has_trigram
+    trigram = None
+    FOREIGN_PROFILE = 'classic'
+    # picks codecs of "text" and "bulk" when they are saved or re-encoded.
+    codec_policy = CodecPolicy()
+    # documents not modified in so many days are archival, see "reencode".
+    archive_days = 365
+
+    def __init__(self, filename, profile=None):
+        """
+        @param profile: name of a storage profile in DocBase.profiles, or a dict of
+               pragmas. DocBase.default_profile is used if it's None.
+        """
         self._filename = filename
+        self._profile = DocBase.default_profile if profile is None else profile
         self._con = sqlite3.connect(filename, **DocBase.date_support)
+        self.apply_profile(self._profile)
+        self._zdicts = {}  # id --> preset dictionary of zlib, loaded on demand
+        try:
+            self.upgrade_()
+            self._fts = self.has_fts_()
+            if self._fts and not DocBase.has_trigram():
+                raise RuntimeError('Database has a full-text index, which needs FTS5 with trigram tokenizer '
+                                   '(SQLite 3.34 or later). SQLite %s here has not.' % sqlite3.sqlite_version)
+        except Exception:
+            self._con.close()
+            raise
+        self._tag_index = {}  # sn --> DBRecordTag, every tag of the forest
         self._tags = self.load_all_tags()
+        self.train_zdict_if_due_()
+
+    def apply_profile(self, profile):
+        if jex.is_str(profile):
+            profile = DocBase.profiles[profile]
+        try:
+            for key in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout'):
+                if key in profile:
+                    self._con.execute('PRAGMA %s=%s' % (key, profile[key]))
+        except Exception as e:
+            print('Error on applying profile: %s' % e)
+
+    def upgrade_(self):
+        """
+        Bring an older database up to date. Every step upgrades the schema by one
+        version, and "PRAGMA user_version" records how many steps have been applied.
+        """
+        steps = [self.build_fts_, self.split_plain_text_, self.build_doc_tags_,
+                 self.index_dates_, self.split_content_, self.index_size_,
+                 self.build_zdicts_, self.nest_tags_,
+                 self.count_tags_, self.digest_docs_, self.build_merkle_,
+                 self.build_changes_, self.prepare_sync_, self.count_docs_once_,
+                 self.fold_plain_]
+        try:
+            cur = self._con.cursor()
+            cur.execute('PRAGMA user_version')
+            version, = cur.fetchone()
+            for i in range(version, len(steps)):
+                self._con.execute('BEGIN')  # every step is done completely or not at all
+                steps[i]()
+                self._con.execute('PRAGMA user_version=%d' % (i + 1))
+                self._con.commit()
+            if version < DocBase.content_split <= len(steps):
+                # splitting content copied every blob, and the old pages are only freed.
+                # VACUUM gives them back, or the file stays twice as large.
+                self._con.execute('VACUUM')
+        except Exception as e:
+            self._con.rollback()
+            print('Error on upgrade: %s' % e)
+            # the code only works on the latest schema, a half-upgraded one can't be used.
+            raise RuntimeError('Database can not be upgraded: %s' % e)
+
+    def upgrade_script_(self, sql):
+        """
+        executescript() always commits pending transaction before running. So it
+        must be the first thing to do in an upgrade step, and it re-opens the
+        transaction of the step.
+        """
+        self._con.executescript('BEGIN;%s' % sql)
+
+    @staticmethod
+    def has_trigram():
+        """
+        @return True if SQLite has FTS5 with trigram tokenizer (since SQLite 3.34).
+        """
+        if DocBase.trigram is None:
+            con = sqlite3.connect(':memory:')
+            try:
+                con.execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize='trigram')")
+                DocBase.trigram = True
+            except sqlite3.Error:
+                DocBase.trigram = False
+            finally:
+                con.close()
+        return DocBase.trigram
+
+    def has_fts_(self):
+        """
+        @return True if "docs_fts" is the full-text index, False if it's the view over
+                "plain" made without trigram tokenizer (see build_fts_).
+        """
+        cur = self._con.cursor()
+        cur.execute("SELECT type FROM sqlite_master WHERE name='docs_fts'")
+        row = cur.fetchone()
+        return row is not None and row[0] == 'table'
+
+    def build_fts_(self):
+        """
+        version 1: full-text index of documents' content.
+        The trigram tokenizer makes substring match possible, which is necessary for
+        languages without spaces between words (e.g., Chinese).
+        @note: without trigram tokenizer (SQLite older than 3.34), "docs_fts" is a plain
+               table, and becomes a view over "plain" in version 2. Searching is done by
+               LIKE then, see match_words_.
+        """
+        if DocBase.has_trigram():
+            self._con.execute("CREATE VIRTUAL TABLE docs_fts USING fts5(body, tokenize='trigram')")
+        else:
+            self._con.execute('CREATE TABLE docs_fts (id INTEGER PRIMARY KEY, body TEXT)')
+        cur = self._con.cursor()
+        cur.execute('SELECT id, text FROM docs')
+        for sn, text in cur:
+            body = DocBase.extract_text_(DocBase.unzip_(text))
+            self._con.execute('INSERT INTO docs_fts (rowid, body) VALUES(?,?)', (sn, body))
+
+    def split_plain_text_(self):
+        """
+        version 2: the extracted text is persisted in table "plain", which can be read
+        directly (e.g., preview). The full-text index becomes an external-content one
+        over it, and it's kept in sync by triggers.
+        """
+        if not DocBase.has_trigram():
+            self.upgrade_script_('''
+                CREATE TABLE plain (
+                id    INTEGER PRIMARY KEY NOT NULL,
+                body  TEXT);
+                INSERT INTO plain (id, body) SELECT rowid, body FROM docs_fts;
+                DROP TABLE docs_fts;
+                CREATE VIEW docs_fts AS SELECT id AS rowid, body FROM plain;''')
+            return
+        self.upgrade_script_('''
+            CREATE TABLE plain (
+            id    INTEGER PRIMARY KEY NOT NULL,
+            body  TEXT);
+            INSERT INTO plain (id, body) SELECT rowid, body FROM docs_fts;
+            DROP TABLE docs_fts;
+            CREATE VIRTUAL TABLE docs_fts USING fts5(body, content='plain', content_rowid='id', tokenize='trigram');
+            INSERT INTO docs_fts (docs_fts) VALUES('rebuild');
+            CREATE TRIGGER plain_ai AFTER INSERT ON plain BEGIN
+              INSERT INTO docs_fts (rowid, body) VALUES (new.id, new.body);
+            END;
+            CREATE TRIGGER plain_ad AFTER DELETE ON plain BEGIN
+              INSERT INTO docs_fts (docs_fts, rowid, body) VALUES('delete', old.id, old.body);
+            END;
+            CREATE TRIGGER plain_au AFTER UPDATE ON plain BEGIN
+              INSERT INTO docs_fts (docs_fts, rowid, body) VALUES('delete', old.id, old.body);
+              INSERT INTO docs_fts (rowid, body) VALUES (new.id, new.body);
+            END;''')
+
+    def build_doc_tags_(self):
+        """
+        version 3: table "doc_tags" links documents and tags, one row for each pair.
+        Filtering by tags then is an indexed lookup rather than parsing column "tags".
+        """
+        self.upgrade_script_('''
+            CREATE TABLE doc_tags (
+            doc_id  INTEGER NOT NULL,
+            tag_id  INTEGER NOT NULL,
+            PRIMARY KEY (doc_id, tag_id)) WITHOUT ROWID;
+            CREATE INDEX doc_tags_tag ON doc_tags (tag_id, doc_id);''')
+        cur = self._con.cursor()
+        cur.execute("SELECT id, tags FROM docs WHERE tags <> ''")
+        pairs = [(sn, int(i)) for sn, tg in cur.fetchall() for i in tg.split(',')]
+        self._con.executemany('INSERT OR IGNORE INTO doc_tags VALUES(?,?)', pairs)
+
+    def index_dates_(self):
+        """
+        version 4: date range filters seek on indices.
+        """
+        self.upgrade_script_('''
+            CREATE INDEX docs_date ON docs (date);
+            CREATE INDEX docs_date2 ON docs (date2);''')
+
+    def split_content_(self):
+        """
+        version 5: large data (text and images) moves to table "content", so that
+        searching and sorting only read the small metadata rows. Their size is
+        precomputed into column "size".
+        """
+        self.upgrade_script_('''
+            CREATE TABLE content (
+            id    INTEGER PRIMARY KEY NOT NULL,
+            text  BLOB,
+            bulk  BLOB);
+            INSERT INTO content (id, text, bulk) SELECT id, text, bulk FROM docs;
+            CREATE TABLE meta (
+            id    INTEGER PRIMARY KEY NOT NULL,
+            title TEXT NOT NULL,
+            tags  TEXT,
+            date  DATE,
+            date2 DATE,
+            size  INTEGER DEFAULT (0));
+            INSERT INTO meta (id, title, tags, date, date2, size)
+              SELECT id, title, tags, date, date2, IFNULL(LENGTH(text), 0) + IFNULL(LENGTH(bulk), 0) FROM docs;
+            DROP TABLE docs;
+            ALTER TABLE meta RENAME TO docs;
+            CREATE INDEX docs_date ON docs (date);
+            CREATE INDEX docs_date2 ON docs (date2);''')
+
+    def index_size_(self):
+        """
+        version 6: every sort key of search result has an index. An index entry ends
+        with rowid, so that indices "docs_date", "docs_date2" and "docs_size" are
+        ordered by (key, id), which is exactly the keyset of DocCursor. And SQLite
+        walks an index in either direction.
+        """
+        self._con.execute('CREATE INDEX docs_size ON docs (size)')
+
+    def build_zdicts_(self):
+        """
+        version 7: preset dictionaries of zlib, trained from documents of this database.
+        The latest one compresses new text; the older ones are kept for decoding.
+        """
+        self._con.execute('''CREATE TABLE zdicts (
+            id    INTEGER PRIMARY KEY NOT NULL,
+            data  BLOB NOT NULL)''')
+        cur = self._con.cursor()
+        cur.execute('SELECT COUNT(*) FROM content')
+        num, = cur.fetchone()
+        if num >= DocBase.ZDICT_MIN_DOCS:
+            self.store_zdict_(DocBase.build_zdict_(self.sample_texts_(DocBase.ZDICT_SAMPLES)))
+
+    def nest_tags_(self):
+        """
+        version 8: interval (nested set) of every tag, so that "tag X is in the subtree of
+        tag Y" is a range query on index "tags_lft". The values are numbered when tags
+        are loaded.
+        """
+        self.upgrade_script_('''
+            ALTER TABLE tags ADD COLUMN lft INTEGER NOT NULL DEFAULT (0);
+            ALTER TABLE tags ADD COLUMN rgt INTEGER NOT NULL DEFAULT (0);
+            CREATE INDEX tags_lft ON tags (lft, rgt);''')
 
-    def read_doc(self, sn):
+    def count_tags_(self):
+        """
+        version 9: usage counts of every tag, kept by triggers on table "doc_tags", so
+        both GUI and background writer keep them right. "uses" counts documents having
+        the tag itself; "total" counts the ones having it or any of its descendants,
+        i.e., "uses" summed over its interval. (It counts a document with two tags of
+        one subtree twice, which is fixed in version 14, see count_docs_once_.)
+        """
+        self.upgrade_script_('''
+            ALTER TABLE tags ADD COLUMN uses INTEGER NOT NULL DEFAULT (0);
+            ALTER TABLE tags ADD COLUMN total INTEGER NOT NULL DEFAULT (0);
+            CREATE TRIGGER doc_tags_ai AFTER INSERT ON doc_tags BEGIN
+              UPDATE tags SET uses=uses+1 WHERE id=new.tag_id;
+              UPDATE tags SET total=total+1
+                WHERE lft <= (SELECT lft FROM tags WHERE id=new.tag_id)
+                  AND rgt >= (SELECT rgt FROM tags WHERE id=new.tag_id);
+            END;
+            CREATE TRIGGER doc_tags_ad AFTER DELETE ON doc_tags BEGIN
+              UPDATE tags SET uses=uses-1 WHERE id=old.tag_id;
+              UPDATE tags SET total=total-1
+                WHERE lft <= (SELECT lft FROM tags WHERE id=old.tag_id)
+                  AND rgt >= (SELECT rgt FROM tags WHERE id=old.tag_id);
+            END;
+            UPDATE tags SET uses=(SELECT COUNT(*) FROM doc_tags WHERE tag_id=tags.id);
+            UPDATE tags SET total=(SELECT SUM(s.uses) FROM tags s WHERE s.lft BETWEEN tags.lft AND tags.rgt);''')
+
+    def digest_docs_(self):
+        """
+        version 10: digest of every document's content, see content_digest_. It's on
+        decoded values, so the same document has the same digest in any database.
+        """
+        self.upgrade_script_('''
+            ALTER TABLE docs ADD COLUMN digest BLOB;
+            CREATE INDEX docs_digest ON docs (digest);''')
+        cur = self._con.cursor()
+        cur.execute('SELECT id, text, bulk FROM content')
+        for sn, text, bulk in cur:
+            digest = DocBase.digest_(hashlib.md5(self.decode_(text)).digest(),
+                                     hashlib.md5(self.decode_(bulk)).digest())
+            self._con.execute('UPDATE docs SET digest=? WHERE id=?', (digest, sn))
+
+    def build_merkle_(self):
+        """
+        version 11: range hashes of documents, see DocBase.MERKLE_BITS. The buckets are
+        kept by triggers on "docs", so both GUI and background writer keep them right.
+        @note: SQLite has no XOR operator, (a | b) - (a & b) is used instead.
+        """
+        self.upgrade_script_('''
+            ALTER TABLE docs ADD COLUMN leaf INTEGER NOT NULL DEFAULT (0);
+            CREATE TABLE merkle (
+              level  INTEGER NOT NULL,
+              bucket INTEGER NOT NULL,
+              hash   INTEGER NOT NULL,
+              PRIMARY KEY (level, bucket)) WITHOUT ROWID;''')
+        buckets = collections.defaultdict(int)
+        cur = self._con.cursor()
+        cur.execute('SELECT id, digest FROM docs')
+        for sn, digest in cur.fetchall():
+            leaf = DocBase.leaf_(sn, digest)
+            self._con.execute('UPDATE docs SET leaf=? WHERE id=?', (leaf, sn))
+            for level in range(1, DocBase.MERKLE_LEVELS + 1):
+                buckets[(level, sn >> (level * DocBase.MERKLE_BITS))] ^= leaf
+        self._con.executemany('INSERT INTO merkle VALUES(?,?,?)', [(l, b, h) for (l, b), h in buckets.items()])
+        def upsert(sn, delta):
+            values = ','.join('(%d, %s >> %d, %s)' % (i, sn, i * DocBase.MERKLE_BITS, delta)
+                              for i in range(1, DocBase.MERKLE_LEVELS + 1))
+            return '''INSERT INTO merkle VALUES %s ON CONFLICT (level, bucket)
+                      DO UPDATE SET hash=(hash | excluded.hash) - (hash & excluded.hash);''' % values
+        self._con.execute('CREATE TRIGGER docs_merkle_ai AFTER INSERT ON docs BEGIN %s END' %
+                          upsert('new.id', 'new.leaf'))
+        self._con.execute('CREATE TRIGGER docs_merkle_ad AFTER DELETE ON docs BEGIN %s END' %
+                          upsert('old.id', 'old.leaf'))
+        self._con.execute('CREATE TRIGGER docs_merkle_au AFTER UPDATE OF leaf ON docs BEGIN %s END' %
+                          upsert('new.id', '((old.leaf | new.leaf) - (old.leaf & new.leaf))'))
+
+    def build_changes_(self):
+        """
+        version 12: journal of changes, fed by triggers on "docs" and "tags". Derived
+        columns (size, leaf of docs; intervals and counts of tags) are not journaled,
+        content is journaled by "digest" of docs. AUTOINCREMENT never reuses "seq",
+        even after the journal is pruned.
         """
-        @return: tuple(str, bytes)
+        sql = ['''CREATE TABLE changes (
+            seq    INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl    TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            op     TEXT NOT NULL);''']
+        for table, columns in (('docs', 'title, tags, date, date2, digest'), ('tags', 'name, base')):
+            for event, op, row in (('INSERT', 'I', 'new'), ('UPDATE OF %s' % columns, 'U', 'new'), ('DELETE', 'D', 'old')):
+                sql.append('''CREATE TRIGGER %s_changes_%s AFTER %s ON %s BEGIN
+                    INSERT INTO changes (tbl, row_id, op) VALUES ('%s', %s.id, '%s');
+                END;''' % (table, op.lower(), event, table, table, row, op))
+        self.upgrade_script_('\n'.join(sql))
+
+    def prepare_sync_(self):
         """
+        version 13: identities and versions for DocSync. A document has a random "uid"
+        which is the same in every database, and a "version" increased by trigger on
+        every change of it. Table "meta" has the uid of database itself. Table
+        "sync_state" remembers versions of both sides when a document was last synced
+        with a peer database.
+        """
+        self.upgrade_script_('''
+            ALTER TABLE docs ADD COLUMN uid TEXT;
+            ALTER TABLE docs ADD COLUMN version INTEGER NOT NULL DEFAULT (1);
+            UPDATE docs SET uid=lower(hex(randomblob(16)));
+            CREATE UNIQUE INDEX docs_uid ON docs (uid);
+            CREATE TRIGGER docs_uid_ai AFTER INSERT ON docs WHEN new.uid IS NULL BEGIN
+              UPDATE docs SET uid=lower(hex(randomblob(16))) WHERE id=new.id;
+            END;
+            CREATE TRIGGER docs_version_au AFTER UPDATE OF title, tags, date, date2, digest ON docs
+              WHEN new.version = old.version BEGIN
+              UPDATE docs SET version=old.version+1 WHERE id=new.id;
+            END;
+            CREATE TABLE meta (
+              key   TEXT PRIMARY KEY NOT NULL,
+              value TEXT);
+            INSERT INTO meta VALUES ('uid', lower(hex(randomblob(16))));
+            CREATE TABLE sync_state (
+              peer   TEXT NOT NULL,
+              uid    TEXT NOT NULL,
+              mine   INTEGER NOT NULL,
+              theirs INTEGER NOT NULL,
+              PRIMARY KEY (peer, uid)) WITHOUT ROWID;''')
+
+    def count_docs_once_(self):
+        """
+        version 14: "total" of a tag counts documents, not tag assignments: a document
+        having a few tags of the subtree (e.g., siblings) is counted once. Triggers
+        only change "total" of the tags whose interval has no other tag of document.
+        """
+        self.upgrade_script_('''
+            DROP TRIGGER doc_tags_ai;
+            DROP TRIGGER doc_tags_ad;
+            CREATE TRIGGER doc_tags_ai AFTER INSERT ON doc_tags BEGIN
+              UPDATE tags SET uses=uses+1 WHERE id=new.tag_id;
+              UPDATE tags SET total=total+1
+                WHERE lft <= (SELECT lft FROM tags WHERE id=new.tag_id)
+                  AND rgt >= (SELECT rgt FROM tags WHERE id=new.tag_id)
+                  AND NOT EXISTS (SELECT 1 FROM doc_tags dt JOIN tags t ON t.id=dt.tag_id
+                                  WHERE dt.doc_id=new.doc_id AND dt.tag_id<>new.tag_id
+                                    AND t.lft BETWEEN tags.lft AND tags.rgt);
+            END;
+            CREATE TRIGGER doc_tags_ad AFTER DELETE ON doc_tags BEGIN
+              UPDATE tags SET uses=uses-1 WHERE id=old.tag_id;
+              UPDATE tags SET total=total-1
+                WHERE lft <= (SELECT lft FROM tags WHERE id=old.tag_id)
+                  AND rgt >= (SELECT rgt FROM tags WHERE id=old.tag_id)
+                  AND NOT EXISTS (SELECT 1 FROM doc_tags dt JOIN tags t ON t.id=dt.tag_id
+                                  WHERE dt.doc_id=old.doc_id
+                                    AND t.lft BETWEEN tags.lft AND tags.rgt);
+            END;
+            UPDATE tags SET total=(SELECT COUNT(DISTINCT dt.doc_id) FROM tags s JOIN doc_tags dt ON dt.tag_id=s.id
+                                   WHERE s.lft BETWEEN tags.lft AND tags.rgt);''')
+
+    def fold_plain_(self):
+        """
+        version 15: lower-case copy of "body" in table "plain" for keywords compared by
+        LIKE (see match_words_), which only ignores case of ASCII letters. It's folded by
+        Python, since lower() of SQLite is ASCII-only, too. "body" keeps the original
+        text for preview.
+        """
+        self.upgrade_script_('''
+            ALTER TABLE plain ADD COLUMN folded TEXT;''')
+        cur = self._con.cursor()
+        cur.execute('SELECT id, body FROM plain')
+        rows = [((body or '').lower(), sn) for sn, body in cur.fetchall()]
+        self._con.executemany('UPDATE plain SET folded=? WHERE id=?', rows)
+
+    def read_doc(self, sn, lazy=False):
+        """
+        @param lazy: if True, images are not read now but on first access.
+        @return: tuple(str, bytes), or tuple(str, LazyBulk) if lazy.
+        """
+        if lazy:
+            return self.read_text(sn), LazyBulk(self, sn)
         try:
             cur = self._con.cursor()
-            cur.execute('SELECT text, bulk FROM docs WHERE id=?', (sn,))
+            cur.execute('SELECT text, bulk FROM content WHERE id=?', (sn,))
             t, b = cur.fetchone()
-            return DocBase.unzip_(t), b
+            return self.decode_text_(t), self.decode_(b)
+        except Exception as e:
+            print('Error on select: %s' % e)
+
+    def read_record(self, sn):
+        """
+        @return: DBRecordDoc object with metadata only, None if not found.
+        """
+        found = self.select_doc(lower=sn, upper=sn)
+        return found[0] if found else None
+
+    def read_text(self, sn):
+        """
+        @return: str, json-format text of document. Images are not read from disk:
+                 column "bulk" is after "text", so its overflow pages are never visited.
+        """
+        try:
+            cur = self._con.cursor()
+            cur.execute('SELECT text FROM content WHERE id=?', (sn,))
+            t, = cur.fetchone()
+            return self.decode_text_(t)
+        except Exception as e:
+            print('Error on select: %s' % e)
+            return ''
+
+    def read_bulk(self, sn):
+        """
+        @return: bytes, a FilePile of all images of document, empty if no image.
+        """
+        try:
+            cur = self._con.cursor()
+            cur.execute('SELECT bulk FROM content WHERE id=?', (sn,))
+            b, = cur.fetchone()
+            return self.decode_(b)
+        except Exception as e:
+            print('Error on select: %s' % e)
+            return b''
+
+    def read_image(self, sn, name):
+        """
+        @param name: name of image in FilePile, see "image" of document's json text.
+        @return: bytes of one image, None if not found.
+        """
+        try:
+            bulk = self.open_bulk(sn)
+            try:
+                return bulk.read(name)
+            finally:
+                bulk.close()
+        except Exception as e:
+            print('Error on select: %s' % e)
+
+    def open_bulk(self, sn):
+        """
+        @return: BulkBlob object, which reads or replaces images of document one by one.
+        """
+        return BulkBlob(self, sn)
+
+    def read_plain(self, sn):
+        """
+        @return: str, the searchable text extracted from document when it was saved.
+        """
+        try:
+            cur = self._con.cursor()
+            cur.execute('SELECT body FROM plain WHERE id=?', (sn,))
+            row = cur.fetchone()
+            return '' if row is None else row[0]
         except Exception as e:
             print('Error on select: %s' % e)
+            return ''
 
-    def copy_docs(self, sn_set, database):
+    def copy_docs(self, sn_set, database, progress=None, batch=16):
         """
-        Copy a few records to another database.
+        Copy a few records to another database, with their tags (matched by path, see
+        tag_path; missing ones are created there). Destination is attached, and images
+        are copied by INSERT ... SELECT inside SQLite, so memory use doesn't grow with
+        the size or number of documents. A document already there (same uid) is skipped.
         @param sn_set: a set of record IDs.
         @param database: filename of destination database.
+        @param progress: callback(int, int), number of visited records and all ones.
+        @return number of copied records.
         """
         try:
-            con = sqlite3.connect(database)
-            # check if sn is continuous
-            up, down = max(sn_set), min(sn_set)
-            if up - down + 1 == len(sn_set):
-                condition = 'id <= %d AND id >= %d' % (up, down)
-            else:
-                condition = 'id in (%s)' % ','.join(str(i) for i in sn_set)
-            # filter records
-            sql_select = 'SELECT title, text, bulk, date, date2 FROM docs WHERE %s' % condition
+            sn_set = sorted(sn_set)
             cur = self._con.cursor()
-            cur.execute(sql_select)
-            # write to new database
-            sql_insert = 'INSERT INTO docs (title, text, bulk, tags, date, date2) VALUES(?,?,?,?,?,?)'
-            docs = [(ttl, txt, blk, '', dat, dat2) for ttl, txt, blk, dat, dat2 in cur.fetchall()]
-            con.executemany(sql_insert, docs)
-            con.commit()
-            return len(docs)
+            rows = []
+            for i in range(0, len(sn_set), 500):  # metadata only, in chunks of parameters
+                chunk = sn_set[i:i + 500]
+                cur.execute('SELECT d.id, d.title, d.tags, d.date, d.date2, d.digest, d.uid, IFNULL(LENGTH(c.bulk), 0) '
+                            'FROM docs d JOIN content c ON c.id=d.id WHERE d.id IN (%s)' % ','.join('?' * len(chunk)), chunk)
+                rows.extend(cur.fetchall())
+            # 1. tags and uids of destination
+            that = DocBase(database, DocBase.FOREIGN_PROFILE)
+            tag_map = {}
+            for row in rows:
+                for i in [] if row[2] in (None, '') else [int(j) for j in row[2].split(',')]:
+                    if i not in tag_map and self.find_tag(i) is not None:
+                        tag_map[i] = that.tag_by_path(self.tag_path(self.find_tag(i)), create=True).sn
+            existed = set(i[1] for i in DocSync.load_docs_(that).values())
+            that.close()
+            # 2. stream documents one by one
+            self._con.execute('ATTACH DATABASE ? AS dst', (database,))
+            num = 0
+            try:
+                for n, (sn, title, tags, date, date2, digest, uid, bulk_size) in enumerate(rows):
+                    if uid in existed:
+                        continue
+                    tags = [] if tags in (None, '') else [tag_map[int(i)] for i in tags.split(',') if int(i) in tag_map]
+                    cur.execute('SELECT text FROM main.content WHERE id=?', (sn,))
+                    text, = cur.fetchone()
+                    script = self.decode_text_(text)
+                    if Codec.of(text) is not None and Codec.of(text).name == 'zdict':  # dictionary is not there
+                        data = script.encode(encoding='utf-8')
+                        text = sqlite3.Binary(Codec.find(DocBase.codec_policy.choose('text', data)).encode(data, None))
+                    cur.execute('INSERT INTO dst.docs (title, tags, date, date2, size, digest, uid) VALUES(?,?,?,?,?,?,?)',
+                                (title, ','.join(str(i) for i in tags), date, date2, len(text) + bulk_size, digest, uid))
+                    target = cur.lastrowid
+                    cur.execute('UPDATE dst.docs SET leaf=? WHERE id=?', (DocBase.leaf_(target, digest), target))
+                    cur.execute('INSERT INTO dst.content (id, text, bulk) SELECT ?, ?, bulk FROM main.content WHERE id=?',
+                                (target, text, sn))
+                    cur.execute('INSERT INTO dst.plain (id, body, folded) VALUES(?,?,?)',
+                                (target,) + DocBase.plain_row_(script))
+                    cur.executemany('INSERT OR IGNORE INTO dst.doc_tags VALUES(?,?)', [(target, i) for i in tags])
+                    num += 1
+                    if num % batch == 0:
+                        self._con.commit()
+                        if progress is not None:
+                            progress(n + 1, len(rows))
+                self._con.commit()
+                if progress is not None:
+                    progress(len(rows), len(rows))
+            except Exception:
+                self._con.rollback()
+                raise
+            finally:
+                self._con.execute('DETACH DATABASE dst')
+            return num
         except Exception as e:
-            print(e)
+            print('Error on copy: %s' % e)
+            return 0
 
     def select_doc(self, **conditions):
         try:
-            clauses = []
-            condition = conditions.pop('title', None)
-            if condition is not None:
-                clauses.append(condition)
-            condition = conditions.pop('from', None)
-            if condition is not None:
-                clauses.append('date >= "%s"' % condition)  # date must be quoted using marks
-            condition = conditions.pop('to', None)
-            if condition is not None:
-                clauses.append('date <= "%s"' % condition)
-            condition = conditions.pop('from2', None)
-            if condition is not None:
-                clauses.append('date2 >= "%s"' % condition)  # date must be quoted using marks
-            condition = conditions.pop('to2', None)
-            if condition is not None:
-                clauses.append('date2 <= "%s"' % condition)
-            tags = conditions.pop('tags', None)
-            #
-            # judge if sn fits in between UPPER and LOWER boundary.
-            # NOTE: the sn in database may not be continuous.
-            upper = conditions.pop('upper', None)
-            lower = conditions.pop('lower', None)
-            def in_range(sn):
-                if upper and sn > upper:
-                    return False
-                if lower and sn < lower:
-                    return False
-                return True
-            if any([upper, lower]):
-                self._con.create_function('InRange', 1, in_range)
-                clauses.append('InRange(id)')
-            #
-            # full-text search
-            words = conditions.pop('content', None)
-            def contain_words(text):
-                content = DocBase.unzip_(text)
-                return DocBase.find_words(content, words)
-            if not words is None:
-                self._con.create_function('Contain', 1, contain_words)
-                clauses.append('Contain(text)')
+            clauses, args = self.compile_conditions_(conditions)
             # construct final SQL statement
-            sql = 'SELECT id,title,tags,date,date2,LENGTH(text)+LENGTH(bulk) FROM docs'
+            sql = 'SELECT id,title,tags,date,date2,size FROM docs'
             if len(clauses) > 0:
                 sql = '%s WHERE %s' % (sql, ' AND '.join(clauses))
             cur = self._con.cursor()
-            cur.execute(sql)
-            docs = []
-            for sn, tt, tg, dt, dt2, sz in cur.fetchall():
-                tg = [] if tg == '' else [int(i) for i in tg.split(',')]
-                tg = [DBRecordTag.forest_find(self._tags, i) for i in tg]
-                if tags is not None:
-                    if not any(DBRecordTag.forest_find(tags, i.sn) for i in tg):
-                        continue
-                docs.append(DBRecordDoc(tt, None, None, tg, dt, dt2, sn, sz))
-            return docs
+            cur.execute(sql, args)
+            return [self.record_from_row_(i) for i in cur.fetchall()]
+        except Exception as e:
+            print('Error on select: %s' % e)
+
+    def query_doc(self, page_size, **conditions):
+        """
+        @param conditions: same as select_doc.
+        @return DocCursor object, which fetches matched documents page by page.
+        """
+        clauses, args = self.compile_conditions_(conditions)
+        return DocCursor(self, clauses, args, page_size)
+
+    def count_doc_(self, where, args):
+        try:
+            cur = self._con.cursor()
+            cur.execute('SELECT COUNT(*) FROM docs WHERE %s' % where, args)
+            num, = cur.fetchone()
+            return num
+        except Exception as e:
+            print('Error on select: %s' % e)
+            return 0
+
+    def fetch_rows_(self, sql, args):
+        try:
+            cur = self._con.cursor()
+            cur.execute(sql, args)
+            return cur.fetchall()
         except Exception as e:
             print('Error on select: %s' % e)
+            return []
+
+    def record_from_row_(self, row):
+        """
+        @param row: tuple(id, title, tags, date, date2, size) of table "docs".
+        """
+        sn, tt, tg, dt, dt2, sz = row
+        tg = [] if tg == '' else [int(i) for i in tg.split(',')]
+        tg = [self._tag_index[i] for i in tg if i in self._tag_index]
+        return DBRecordDoc(tt, None, None, tg, dt, dt2, sn, sz)
+
+    def compile_conditions_(self, conditions):
+        """
+        @param conditions: dict of search conditions, supports
+            1. title: array of lower-case keywords (AND)
+            2. from / to: date objects, range of creation date
+            3. from2 / to2: date objects, range of modification date
+            4. tags: array of DBRecordTag objects (OR), descendants included, by their
+                     intervals
+            5. lower / upper: range of record ID
+            6. content: array of lower-case keywords (AND)
+        @return tuple(array of SQL conditions on table "docs", array of parameters)
+        @note: all values are bound as parameters, so that indices on "id", "date"
+               and "date2" can be used for range seek.
+        """
+        clauses, args = [], []
+        keywords = conditions.get('title', None)
+        if keywords is not None:
+            for i in keywords:
+                clauses.append('title LIKE ?')
+                args.append('%%%s%%' % i)
+        for key, column, op in [('from', 'date', '>='), ('to', 'date', '<='),
+                                ('from2', 'date2', '>='), ('to2', 'date2', '<='),
+                                ('lower', 'id', '>='), ('upper', 'id', '<=')]:
+            value = conditions.get(key, None)
+            if value is not None:
+                clauses.append('%s %s ?' % (column, op))
+                args.append(value)
+        tags = conditions.get('tags', None)
+        if tags is not None and len(tags) > 0:
+            ranges = ' OR '.join('t.lft BETWEEN ? AND ?' for i in tags)
+            clauses.append('id IN (SELECT dt.doc_id FROM tags t JOIN doc_tags dt ON dt.tag_id=t.id WHERE %s)' % ranges)
+            for i in tags:
+                args.extend((i.lft, i.rgt))
+        elif tags is not None:
+            clauses.append('0')
+        # full-text search
+        words = conditions.get('content', None)
+        if words is not None:
+            more, params = DocBase.match_words_(words, self._fts)
+            clauses.extend(more)
+            args.extend(params)
+        return clauses, args
+
+    @staticmethod
+    def match_words_(words, fts=True):
+        """
+        @param words: array of lower-case keywords, all of which must be found (AND).
+        @param fts: False if there's no full-text index, see build_fts_.
+        @return tuple(array of SQL conditions on table "docs", array of their parameters)
+        @note: trigram index only works for keyword of 3 characters at least. Shorter
+               ones are compared by LIKE on the lower-case text (see fold_plain_), which
+               is still free of decompression.
+        """
+        clauses, args = [], []
+        phrases = ['"%s"' % i.replace('"', '""') for i in words if len(i) >= 3 and fts]
+        if len(phrases) > 0:
+            clauses.append('id IN (SELECT rowid FROM docs_fts WHERE docs_fts MATCH ?)')
+            args.append(' AND '.join(phrases))
+        likes = []
+        for i in words:
+            if len(i) < 3 or not fts:
+                i = i.lower().replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                likes.append("folded LIKE ? ESCAPE '\\'")
+                args.append('%%%s%%' % i)
+        if len(likes) > 0:
+            clauses.append('id IN (SELECT id FROM plain WHERE %s)' % ' AND '.join(likes))
+        return clauses, args
 
     def update_doc(self, record: DBRecordDoc):
+        self.save_docs([record])
+
+    def insert_doc(self, record: DBRecordDoc):
+        self.save_docs([record])
+
+    def save_docs(self, records):
+        """
+        Unit of work: write a batch of documents (new or dirty) in one transaction,
+        so that saving many documents costs only one commit.
+        @param records: array of DBRecordDoc objects.
+        @return True if all of them are saved, otherwise none of them is saved.
+        """
+        inserted = []
+        written = [set(i.unsaved_fields) for i in records]
+        try:
+            for record, fields in zip(records, written):
+                if record.fragile:
+                    inserted.append(record)
+                    self.insert_doc_(record)
+                else:
+                    self.update_doc_(record, fields)
+            self._con.commit()
+        except Exception as e:
+            self._con.rollback()
+            for record in inserted:
+                record.sn = 0  # still not in database
+            print('Error on saving: %s' % e)
+            return False
+        for record, fields in zip(records, written):
+            record.after_saving(fields)
+        self.train_zdict_if_due_()
+        return True
+
+    def update_doc_(self, record, fields):
         args = {}
         cols = []
-        for i in record.unsaved_fields:
+        data = {}
+        blobs = []
+        for i in fields:
             if i == DocCols.title:
                 args['ttl'] = record.title
                 cols.append('title=:ttl')
-            elif i == DocCols.text:
-                args['txt'] = DocBase.zip_(record.script)
-                cols.append('text=:txt')
-            elif i == DocCols.bulk:
-                args['blk'] = sqlite3.Binary(record.bulk)
-                cols.append('bulk=:blk')
+            elif i == ContentCols.text:
+                data['txt'] = self.encode_text_(record.script)
+                blobs.append('text=:txt')
+            elif i == ContentCols.bulk:
+                data['blk'] = self.encode_('bulk', record.bulk)
+                blobs.append('bulk=:blk')
             elif i == DocCols.tags:
                 args['tgs'] = DBRecordDoc.tags_str(record.tags)
                 cols.append('tags=:tgs')
@@ -418,59 +1314,157 @@ class DocBase(object):
             elif i == DocCols.date2:
                 args['dt2'] = record.date_modified
                 cols.append('date2=:dt2')
-        try:
-            if len(cols) > 0:
-                sql = 'UPDATE docs SET %s WHERE id=%d' % (', '.join(cols), record.sn)
-                self._con.execute(sql, args)
-                self._con.commit()
-        except Exception as e:
-            print('Error on update: %s' % e)
-        finally:
-            record.after_saving()
+        if len(blobs) > 0:
+            sql = 'UPDATE content SET %s WHERE id=%d' % (', '.join(blobs), record.sn)
+            self._con.execute(sql, data)
+            args['dgt'] = self.content_digest_(record)
+            args['lf'] = DocBase.leaf_(record.sn, args['dgt'])
+            cols.append('digest=:dgt')
+            cols.append('leaf=:lf')
+            cols.append('size=(SELECT IFNULL(LENGTH(text), 0) + IFNULL(LENGTH(bulk), 0) FROM content WHERE id=%d)' % record.sn)
+        if len(cols) > 0:
+            sql = 'UPDATE docs SET %s WHERE id=%d' % (', '.join(cols), record.sn)
+            self._con.execute(sql, args)
+        if ContentCols.text in fields:
+            self._con.execute('UPDATE plain SET body=?, folded=? WHERE id=?',
+                              DocBase.plain_row_(record.script) + (record.sn,))
+        if DocCols.tags in fields:
+            self.link_tags_(record.sn, record.tags)
+
+    def insert_doc_(self, record):
+        text = self.encode_text_(record.script)  # main text
+        bulk = self.encode_('bulk', record.bulk)  # images
+        digest = self.content_digest_(record)
+        sql = 'INSERT INTO docs (title, tags, date, date2, size, digest) VALUES(?,?,?,?,?,?)'
+        args = (record.title,
+                DBRecordDoc.tags_str(record.tags),
+                record.date_created,
+                record.date_modified,
+                len(text) + len(bulk),
+                digest)
+        cur = self._con.cursor()
+        cur.execute(sql, args)
+        record.sn = cur.lastrowid
+        cur.execute('UPDATE docs SET leaf=? WHERE id=?', (DocBase.leaf_(record.sn, digest), record.sn))  # id is known now
+        cur.execute('INSERT INTO content (id, text, bulk) VALUES(?,?,?)', (record.sn, text, bulk))
+        cur.execute('INSERT INTO plain (id, body, folded) VALUES(?,?,?)', (record.sn,) + DocBase.plain_row_(record.script))
+        self.link_tags_(record.sn, record.tags)
+
+    def content_digest_(self, record):
+        """
+        @return digest of document's content. Digests of its text and images are known
+                by record mostly; an unknown one is computed from the stored value.
+        """
+        parts = []
+        for field in ('text', 'bulk'):
+            digest = record.digest_of(field)
+            if digest is None:
+                value = b''
+                if not record.fragile:
+                    cur = self._con.cursor()
+                    cur.execute('SELECT %s FROM content WHERE id=?' % field, (record.sn,))
+                    value = self.decode_(cur.fetchone()[0])
+                digest = hashlib.md5(value).digest()
+            parts.append(digest)
+        return DocBase.digest_(*parts)
 
-    def insert_doc(self, record: DBRecordDoc):
-        try:
-            sql = 'INSERT INTO docs (title, text, bulk, tags, date, date2) VALUES(?,?,?,?,?,?)'
-            args = (record.title,                 # title
-                    DocBase.zip_(record.script),  # main text
-                    sqlite3.Binary(record.bulk),  # images
-                    DBRecordDoc.tags_str(record.tags),
-                    record.date_created,
-                    record.date_modified)
-            cur = self._con.cursor()
-            cur.execute(sql, args)
-            self._con.commit()
-            record.sn = cur.lastrowid
-            record.after_saving()
-        except Exception as e:
-            print('Error on insertion: %s' % e)
+    @staticmethod
+    def digest_(text_md5, bulk_md5):
+        """
+        @param text_md5, bulk_md5: md5 of decoded text and images, see DBRecordDoc.
+        """
+        return sqlite3.Binary(hashlib.sha1(text_md5 + bulk_md5).digest())
+
+    @staticmethod
+    def leaf_(sn, digest):
+        """
+        @return leaf of Merkle tree: signed 64-bit hash of document's id and digest.
+        """
+        m = hashlib.sha1(struct.pack('>q', sn))
+        m.update(b'' if digest is None else bytes(digest))
+        return struct.unpack('>q', m.digest()[:8])[0]
+
+    def link_tags_(self, sn, tags):
+        """
+        keep table "doc_tags" consistent with document's tags. Caller commits.
+        """
+        self._con.execute('DELETE FROM doc_tags WHERE doc_id=?', (sn,))
+        self._con.executemany('INSERT OR IGNORE INTO doc_tags VALUES(?,?)', [(sn, i.sn) for i in tags])
 
     def delete_doc(self, sn):
         try:
-            self._con.execute('DELETE FROM docs WHERE id=?', (sn,))
+            self.delete_doc_(sn)
             self._con.commit()
             return True
         except Exception as e:
             print('Error on deletion: %s' % e)
             return False
 
+    def delete_doc_(self, sn):
+        self._con.execute('DELETE FROM docs WHERE id=?', (sn,))
+        self._con.execute('DELETE FROM content WHERE id=?', (sn,))
+        self._con.execute('DELETE FROM plain WHERE id=?', (sn,))
+        self._con.execute('DELETE FROM doc_tags WHERE doc_id=?', (sn,))
+
+    def put_doc_(self, record, uid, text, bulk, digest):
+        """
+        Write a document coming from another database: encoded values and digest are
+        stored as they are. Inserted if record.sn is 0, otherwise updated. Caller commits.
+        @param text, bulk: encoded values, which must not depend on the other database
+               (see DocSync.portable_).
+        @return version of the document in this database.
+        """
+        cur = self._con.cursor()
+        size = len(text) + len(bulk)
+        if record.fragile:
+            cur.execute('INSERT INTO docs (title, tags, date, date2, size, digest, uid) VALUES(?,?,?,?,?,?,?)',
+                        (record.title, DBRecordDoc.tags_str(record.tags), record.date_created,
+                         record.date_modified, size, digest, uid))
+            record.sn = cur.lastrowid
+            cur.execute('INSERT INTO content (id, text, bulk) VALUES(?,?,?)', (record.sn, text, bulk))
+            cur.execute('INSERT INTO plain (id, body, folded) VALUES(?,?,?)', (record.sn,) + DocBase.plain_row_(record.script))
+        else:
+            cur.execute('UPDATE docs SET title=?, tags=?, date=?, date2=?, size=?, digest=? WHERE id=?',
+                        (record.title, DBRecordDoc.tags_str(record.tags), record.date_created,
+                         record.date_modified, size, digest, record.sn))
+            cur.execute('UPDATE content SET text=?, bulk=? WHERE id=?', (text, bulk, record.sn))
+            cur.execute('UPDATE plain SET body=?, folded=? WHERE id=?', DocBase.plain_row_(record.script) + (record.sn,))
+        cur.execute('UPDATE docs SET leaf=? WHERE id=?', (DocBase.leaf_(record.sn, digest), record.sn))
+        self.link_tags_(record.sn, record.tags)
+        cur.execute('SELECT version FROM docs WHERE id=?', (record.sn,))
+        return cur.fetchone()[0]
+
     def close(self):
         self._con.close()
         self._filename = None
 
     def load_all_tags(self):
+        """
+        Build the forest in one pass over an id-indexed dict, so it's linear in number
+        of tags, and a child may come before its parent in rows.
+        @return array of root tags.
+        """
         try:
             cur = self._con.cursor()
-            cur.execute('SELECT * FROM tags')
-            tags = [DBRecordTag(n, b, s) for s, n, b in cur.fetchall()]
-            root = 0
-            for tag in tags[:]:
+            cur.execute('SELECT id, name, base, lft, rgt FROM tags ORDER BY id')
+            self._tag_index.clear()
+            for s, n, b, l, r in cur.fetchall():
+                tag = DBRecordTag(n, b, s)
+                tag.lft, tag.rgt = l, r
+                self._tag_index[s] = tag
+            tags = []
+            for tag in self._tag_index.values():
                 if tag.parent == 0:
-                    root += 1
-                elif DBRecordTag.forest_organize(tags, tag):
-                    tags.remove(tag)
-            if root != len(tags):
-                raise Exception('Error: dangling node: %s found. Program has bugs!' % (len(tags)-root))
+                    tags.append(tag)
+                elif tag.parent in self._tag_index:
+                    self._tag_index[tag.parent].children.append(tag)  # no duplicate, add_child is slower
+            # a tag unreachable from roots: its parent is missing, or it's in a cycle.
+            reached = sum(len(i.all_family()) for i in tags)
+            if reached != len(self._tag_index):
+                raise Exception('Error: dangling node: %s found. Program has bugs!' % (len(self._tag_index)-reached))
+            if self.number_tags_(tags) > 0:
+                self.sum_usage_()
+                self._con.commit()
             return tags
         except Exception as e:
             print('Error on loading tags: %s' % e)
@@ -484,6 +1478,9 @@ class DocBase(object):
                 columns = (TagCols.name[1], TagCols.name[2])
             cur.execute('INSERT INTO tags (%s, %s) VALUES(?,?)' % columns, (tag.name, tag.parent))
             tag.sn = cur.lastrowid
+            self._tag_index[tag.sn] = tag
+            self.link_tag_(tag)
+            self.number_tags_(self._tags)
             self._con.commit()
         except Exception as e:
             print('Error on insertion: %s' % e)
@@ -496,10 +1493,16 @@ class DocBase(object):
             cur = self._con.cursor()
             cur.executemany('DELETE FROM tags WHERE id=?', family)
             self._con.commit()
+            self.unlink_tag_(tag)
+            for sn, in family:
+                self._tag_index.pop(sn, None)
         except Exception as e:
             print('Error on deletion: %s' % e)
 
     def update_tag(self, tag):
+        """
+        @note: to change parent of a tag, use move_tag instead.
+        """
         try:
             cur = self._con.cursor()
             cur.execute('UPDATE tags SET name=?, base=? WHERE id=?', (tag.name, tag.parent, tag.sn))
@@ -507,28 +1510,174 @@ class DocBase(object):
         except Exception as e:
             print('Error on update: %s' % e)
 
+    def move_tag(self, tag, parent):
+        """
+        @param parent: sn of new parent tag, 0 means root.
+        """
+        self.unlink_tag_(tag)
+        tag.parent = parent
+        self.link_tag_(tag)
+        try:
+            self.number_tags_(self._tags)
+            self.sum_usage_()
+        except Exception as e:
+            print('Error on numbering: %s' % e)
+        self.update_tag(tag)
+
+    def sum_usage_(self):
+        """
+        Recompute column "total" of the forest, after tags are moved: every document
+        counts once for each of its tags and their ancestors, even if it has a few tags
+        under one ancestor. Only changed rows are written, caller commits.
+        """
+        cur = self._con.cursor()
+        cur.execute('SELECT id, total FROM tags')
+        rows = dict(cur.fetchall())
+        totals = collections.Counter()
+        cur.execute('SELECT doc_id, tag_id FROM doc_tags ORDER BY doc_id')
+        for _, pairs in itertools.groupby(cur, key=lambda r: r[0]):
+            above = set()  # tags of document and their ancestors
+            for _, sn in pairs:
+                while sn in self._tag_index and sn not in above:
+                    above.add(sn)
+                    sn = self._tag_index[sn].parent
+            totals.update(above)
+        changed = [(totals[s], s) for s, t in rows.items() if totals[s] != t]
+        if len(changed) > 0:
+            self._con.executemany('UPDATE tags SET total=? WHERE id=?', changed)
+
+    def number_tags_(self, tags):
+        """
+        Number the forest in pre-order: a tag gets "lft" when entered and "rgt" when
+        left. Children are visited by sn, so the numbers don't depend on the order in
+        which tags are loaded. Only changed rows are written, caller commits.
+        @note: deletion leaves gaps in numbers, which is fine. So it's not needed then.
+        @return number of changed tags.
+        """
+        changed = {}
+        counter = 0
+        stack = [(i, False) for i in sorted(tags, key=lambda t: t.sn, reverse=True)]
+        while len(stack) > 0:
+            tag, left = stack.pop()
+            counter += 1
+            if left:
+                if tag.rgt != counter:
+                    tag.rgt = counter
+                    changed[tag.sn] = tag
+                continue
+            if tag.lft != counter:
+                tag.lft = counter
+                changed[tag.sn] = tag
+            stack.append((tag, True))
+            stack.extend((i, False) for i in sorted(tag.children, key=lambda t: t.sn, reverse=True))
+        if len(changed) > 0:  # even an empty executemany begins a transaction
+            self._con.executemany('UPDATE tags SET lft=?, rgt=? WHERE id=?',
+                                  [(i.lft, i.rgt, i.sn) for i in changed.values()])
+        return len(changed)
+
+    def find_tag(self, sn):
+        """
+        @return DBRecordTag object, None if not found. It's constant time.
+        """
+        return self._tag_index.get(sn, None)
+
+    def link_tag_(self, tag):
+        """
+        hang a registered tag on its parent, or on the forest if it's a root.
+        """
+        if tag.parent == 0:
+            self._tags.append(tag)
+        else:
+            self._tag_index[tag.parent].add_child(tag)
+
+    def unlink_tag_(self, tag):
+        siblings = self._tags if tag.parent == 0 else self._tag_index[tag.parent].children
+        if tag in siblings:
+            siblings.remove(tag)
+
     def get_all_tags(self):
         return self._tags
 
+    def tag_path(self, tag):
+        """
+        @return tuple of names from root down to the tag, which identifies a tag in any
+                database (ids don't).
+        """
+        names = []
+        while tag is not None:
+            names.append(tag.name)
+            tag = self._tag_index.get(tag.parent, None)
+        names.reverse()
+        return tuple(names)
+
+    def tag_by_path(self, path, create=False):
+        """
+        @param path: tuple of names, see tag_path.
+        @param create: create missing tags along the path.
+        @return DBRecordTag object, None if not found.
+        """
+        tag, siblings = None, self._tags
+        for name in path:
+            found = [i for i in siblings if i.name == name]
+            if len(found) > 0:
+                tag = found[0]
+            elif create:
+                tag = DBRecordTag(name, 0 if tag is None else tag.sn)
+                self.insert_tag(tag)
+            else:
+                return None
+            siblings = tag.children
+        return tag
+
     def check_use(self, tag):
-        def in_use(owned):
-            if owned == '':
-                return False
-            owned = [int(i) for i in owned.split(',')]
-            return any(tag.find(i) for i in owned)
+        """
+        @return number of documents which have this tag or its descendants.
+        """
         try:
-            self._con.create_function('InUse', 1, in_use)
             cur = self._con.cursor()
-            cur.execute('SELECT COUNT(id) from docs WHERE InUse(tags)')
+            cur.execute('SELECT total FROM tags WHERE id=?', (tag.sn,))
             num, = cur.fetchone()
             return num
         except Exception as e:
             print('Error on checking: %s' % e)
 
+    def tag_usage(self):
+        """
+        @return dict: sn --> tuple(uses, total), usage counts of every tag.
+        """
+        try:
+            cur = self._con.cursor()
+            cur.execute('SELECT id, uses, total FROM tags')
+            return dict((s, (u, t)) for s, u, t in cur.fetchall())
+        except Exception as e:
+            print('Error on checking: %s' % e)
+            return {}
+
     @property
     def source(self):
         return self._filename
 
+    @property
+    def uid(self):
+        """
+        identity of database, which is used by its peers in sync.
+        """
+        cur = self._con.cursor()
+        cur.execute("SELECT value FROM meta WHERE key='uid'")
+        return cur.fetchone()[0]
+
+    def renew_uid_(self):
+        """
+        a database copied as a file has the same uid as its origin, give it a new one.
+        """
+        self._con.execute("UPDATE meta SET value=lower(hex(randomblob(16))) WHERE key='uid'")
+        self._con.execute('DELETE FROM sync_state')
+        self._con.commit()
+
+    @property
+    def profile(self):
+        return self._profile
+
     @staticmethod
     def validate(filename):
         def is_column_identical(cursor, table_name, table_columns):
@@ -539,18 +1688,25 @@ class DocBase(object):
         try:
             with sqlite3.connect(filename) as con:
                 cur = con.cursor()
+                cur.execute('PRAGMA user_version')
+                version, = cur.fetchone()
                 if jex.isPython3():
                     tables = {'docs': [DocCols(i).name for i in range(DocCols.COUNT.value)],
+                              'content': [ContentCols(i).name for i in range(ContentCols.COUNT.value)],
                               'tags': [TagCols(i).name for i in range(TagCols.COUNT.value)]}
                 else:
                     tables = {'docs': [DocCols.name[i] for i in range(DocCols.COUNT)],
+                              'content': [ContentCols.name[i] for i in range(ContentCols.COUNT)],
                               'tags': [TagCols.name[i] for i in range(TagCols.COUNT)]}
+                if version < DocBase.content_split:  # it will be upgraded when opened
+                    tables.pop('content')
+                    tables['docs'] = DocBase.legacy_doc_cols
                 return all(is_column_identical(cur, i, j) for i, j in tables.items())
         except:
             return False
 
     @staticmethod
-    def create_db(filename):
+    def create_db(filename, profile=None):
         try:
             sql = '''CREATE TABLE docs (
                 id    INTEGER PRIMARY KEY UNIQUE NOT NULL,
@@ -567,16 +1723,20 @@ class DocBase(object):
             con = sqlite3.connect(filename, **DocBase.date_support)
             con.executescript(sql)
             con.commit()
-            #
-            return DocBase(filename)
+            con.close()
+            # it's the original layout, which is upgraded to the latest when opened.
+            return DocBase(filename, profile)
         except Exception as e:
             print('Error on creation of DB: %s' % e)
             return None
 
     @staticmethod
     def zip_(s):
+        """
+        @note: the original format of column "text", which is a bare zlib stream.
+        """
         if len(s) == 0:
-            return sqlite3.Binary('')
+            return sqlite3.Binary(b'')
         s = s.encode(encoding='utf-8')  # zlib accepts only str, not unicode str.
         return sqlite3.Binary(zlib.compress(s, 6))
 
@@ -587,24 +1747,806 @@ class DocBase(object):
         s = zlib.decompress(s)
         return s.decode(encoding='utf-8')
 
+    # Range hashes (Merkle tree) over document ids: bucket "b" of level "l" covers ids
+    # [b << (l * MERKLE_BITS), (b + 1) << (l * MERKLE_BITS)), its hash is XOR of the
+    # leaves (column "leaf" of table "docs") in it. XOR can be updated incrementally.
+    MERKLE_BITS = 4  # fan-out is 16
+    MERKLE_LEVELS = 6  # the top level has one bucket for 16M documents
+
+    ZDICT_SIZE = 32 * 1024  # zlib looks back 32KB at most, so larger one is useless
+    ZDICT_MIN_DOCS = 32  # too few documents can't tell what is common
+    ZDICT_SAMPLES = 400
+
+    def encode_(self, column, data, archival=False, policy=None):
+        """
+        @param column: 'text' or 'bulk'.
+        @param data: bytes.
+        @param policy: CodecPolicy object, DocBase.codec_policy if it's None.
+        @return encoded value, starting with id of codec (empty value stays empty).
+        """
+        if data is None or len(data) == 0:
+            return sqlite3.Binary(b'')
+        policy = DocBase.codec_policy if policy is None else policy
+        has_zdict = column == 'text' and self.current_zdict_()[1] is not None
+        codec = Codec.find(policy.choose(column, data, archival, has_zdict))
+        return sqlite3.Binary(codec.encode(data, self))
+
+    def decode_(self, data):
+        """
+        @return bytes, decoded value of "text" or "bulk".
+        """
+        if data is None or len(data) == 0:
+            return b''
+        codec = Codec.of(data)
+        if codec is not None:
+            return codec.decode(data, self)
+        if data[0] == 0x78:  # legacy "text": bare zlib stream
+            return zlib.decompress(data)
+        return bytes(data)  # legacy "bulk": FilePile as it is
+
+    def encode_text_(self, s):
+        return self.encode_('text', s.encode(encoding='utf-8'))
+
+    def decode_text_(self, s):
+        return self.decode_(s).decode(encoding='utf-8')
+
+    def reencode(self, archive_days=None, policy=None, batch=64, progress=None):
+        """
+        Encode stored documents again by codec policy: documents modified in recent days
+        get the fast codec, older ones the dense codec, legacy values get codec headers.
+        It commits every batch, so it can run in background (e.g., "python jcli.py
+        reencode") while the database is open elsewhere.
+        @param progress: callback(int, int), id of last visited document and number of
+               rewritten ones.
+        @return number of rewritten documents, -1 if failed.
+        """
+        if archive_days is None:
+            archive_days = DocBase.archive_days
+        if policy is None:
+            policy = DocBase.codec_policy
+        cutoff = datetime.date.today() - datetime.timedelta(days=archive_days)
+        sql = 'SELECT c.id, c.text, c.bulk, d.date2 FROM content c JOIN docs d ON d.id=c.id ' \
+              'WHERE c.id > ? ORDER BY c.id LIMIT ?'
+        last, num = 0, 0
+        try:
+            has_zdict = self.current_zdict_()[1] is not None
+            cur = self._con.cursor()
+            while True:
+                cur.execute(sql, (last, batch))
+                rows = cur.fetchall()
+                if len(rows) == 0:
+                    break
+                for sn, text, bulk, date2 in rows:
+                    archival = date2 is None or date2 < cutoff
+                    values = []
+                    for column, value in (('text', text), ('bulk', bulk)):
+                        data = self.decode_(value)
+                        name = policy.choose(column, data, archival, column == 'text' and has_zdict)
+                        codec = Codec.of(value)
+                        if len(data) > 0 and (codec is None or codec.name != name):
+                            value = sqlite3.Binary(Codec.find(name).encode(data, self))
+                        values.append(value)
+                    if values[0] is text and values[1] is bulk:
+                        continue
+                    self._con.execute('UPDATE content SET text=?, bulk=? WHERE id=?', (values[0], values[1], sn))
+                    self._con.execute('UPDATE docs SET size=? WHERE id=?', (len(values[0]) + len(values[1]), sn))
+                    num += 1
+                self._con.commit()
+                last = rows[-1][0]
+                if progress is not None:
+                    progress(last, num)
+            return num
+        except Exception as e:
+            self._con.rollback()
+            print('Error on re-encoding: %s' % e)
+            return -1
+
+    def current_zdict_(self):
+        """
+        @return tuple(id, bytes) of the latest dictionary, or (0, None) if not trained.
+        """
+        cur = self._con.cursor()
+        cur.execute('SELECT MAX(id) FROM zdicts')
+        sn, = cur.fetchone()
+        if sn is None:
+            return 0, None
+        return sn, self.zdict_(sn)
+
+    def zdict_(self, sn):
+        if sn not in self._zdicts:
+            cur = self._con.cursor()
+            cur.execute('SELECT data FROM zdicts WHERE id=?', (sn,))
+            data, = cur.fetchone()
+            self._zdicts[sn] = bytes(data)
+        return self._zdicts[sn]
+
+    def sample_texts_(self, num):
+        """
+        @return array of bytes, decoded "text" of randomly selected documents.
+        """
+        cur = self._con.cursor()
+        cur.execute('SELECT text FROM content WHERE id IN (SELECT id FROM docs ORDER BY RANDOM() LIMIT ?)', (num,))
+        return [self.decode_text_(t).encode(encoding='utf-8') for t, in cur.fetchall()]
+
+    def train_zdict(self, samples=None):
+        """
+        Train a new preset dictionary, which is used for new text since now.
+        @param samples: array of bytes. If None, documents are sampled randomly.
+        @return id of the dictionary, 0 if failed.
+        """
+        try:
+            if samples is None:
+                samples = self.sample_texts_(DocBase.ZDICT_SAMPLES)
+            sn = self.store_zdict_(DocBase.build_zdict_(samples))
+            self._con.commit()
+            return sn
+        except Exception as e:
+            print('Error on training: %s' % e)
+            return 0
+
+    def train_zdict_if_due_(self):
+        """
+        Train the first dictionary once there are enough documents, checked when database
+        is opened and after saving. A new one later is trained on demand (jcli.py zdict).
+        """
+        try:
+            if self.current_zdict_()[1] is not None:
+                return
+            cur = self._con.cursor()
+            cur.execute('SELECT COUNT(*) FROM docs')
+            num, = cur.fetchone()
+            if num >= DocBase.ZDICT_MIN_DOCS:
+                self.train_zdict()
+        except Exception as e:
+            print('Error on training: %s' % e)
+
+    def store_zdict_(self, zdict):
+        if len(zdict) == 0:
+            return 0
+        cur = self._con.cursor()
+        cur.execute('INSERT INTO zdicts (data) VALUES(?)', (sqlite3.Binary(zdict),))
+        self._zdicts[cur.lastrowid] = zdict
+        return cur.lastrowid
+
+    @staticmethod
+    def build_zdict_(samples, size=ZDICT_SIZE):
+        """
+        Documents share a lot of json snippets, e.g., '"font": {"family": "Helvetica", ',
+        positions like '"pos": "3.0", '. Snippets ended with json punctuation are counted,
+        and the ones saving most bytes (frequency * length) are put in dictionary.
+        @param samples: array of bytes.
+        """
+        counts = collections.Counter()
+        for sample in samples:
+            snippets = set(re.findall(rb'[^,:{}\[\]]*[,:{}\[\]]', sample))  # each counts once per document
+            counts.update(i for i in snippets if 3 < len(i) < 256)
+        common = sorted(((n * len(i), i) for i, n in counts.items() if n > 1), reverse=True)
+        chosen, total = [], 0
+        for score, snippet in common:
+            if total + len(snippet) <= size:
+                chosen.append(snippet)
+                total += len(snippet)
+        chosen.reverse()  # the most valuable ones at the end, which are the nearest to data
+        return b''.join(chosen)
+
+    @staticmethod
+    def extract_text_(script):
+        """
+        @param script: json-format string of a document.
+        @return all searchable text: main text, every table cell and every tip.
+        """
+        if script is None or len(script) == 0:
+            return ''
+        root = json.loads(script)
+        text = [root.get('text', '')]
+        for t in root.get('table', []):
+            text.extend([cell['text'] for row in t['specs'] for cell in row])
+        for t in root.get('tip', []):
+            text.append(t['text'])
+        return '\n'.join(text)
+
     @staticmethod
-    def assign_finder(function):
-        DocBase.find_words = function
+    def plain_row_(script):
+        """
+        @return tuple(body, folded) of table "plain": searchable text, and its lower-case
+                copy (see fold_plain_).
+        """
+        body = DocBase.extract_text_(script)
+        return body, body.lower()
+
+    def changes_since(self, seq, limit=None):
+        """
+        @param seq: the last sequence number processed by caller, 0 for all.
+        @return array of tuple(seq, table, id, op) in order, where table is 'docs' or
+                'tags', op is 'I' (insert), 'U' (update) or 'D' (delete).
+        """
+        try:
+            cur = self._con.cursor()
+            sql = 'SELECT seq, tbl, row_id, op FROM changes WHERE seq > ? ORDER BY seq'
+            if limit is None:
+                cur.execute(sql, (seq,))
+            else:
+                cur.execute(sql + ' LIMIT ?', (seq, limit))
+            return cur.fetchall()
+        except Exception as e:
+            print('Error on select: %s' % e)
+            return []
+
+    def last_change(self):
+        """
+        @return sequence number of the latest change, 0 if nothing changed.
+        """
+        try:
+            cur = self._con.cursor()
+            cur.execute("SELECT seq FROM sqlite_sequence WHERE name='changes'")
+            row = cur.fetchone()
+            return 0 if row is None else row[0]
+        except Exception as e:
+            print('Error on select: %s' % e)
+            return 0
+
+    def prune_changes(self, seq):
+        """
+        forget changes up to seq, after all consumers have processed them.
+        """
+        try:
+            self._con.execute('DELETE FROM changes WHERE seq <= ?', (seq,))
+            self._con.commit()
+        except Exception as e:
+            print('Error on deletion: %s' % e)
 
     def get_hashes(self):
-        def my_hash(text: bytes, bulk: bytes):
-            m = hashlib.sha1()
-            m.update(text)
-            m.update(bulk)
-            return m.hexdigest()
+        """
+        @return array of tuple(id, title, hex digest of content).
+        """
         results = []
         try:
-            self._con.create_function('MY_HASH', 2, my_hash)
-            sql = 'SELECT id,title,MY_HASH(text, bulk) FROM docs'
             cur = self._con.cursor()
-            cur.execute(sql)
+            cur.execute('SELECT id, title, digest FROM docs')
             for sn, title, digest in cur.fetchall():
-                results.append((sn, title, digest))
+                results.append((sn, title, bytes(digest).hex()))
         except Exception as e:
             print(e)
         return results
+
+    def compare_docs(self, database):
+        """
+        Find documents whose content is not in another database.
+        @param database: filename of another database.
+        @return tuple(array of (id, title) only in this one, array of (id, title) only in that one)
+        @note: range hashes of both sides are compared top-down, so only the differing
+               ids are visited, see diff_ids_. A differing document whose content is
+               stored under another id over there is not reported, by digest.
+        @note: errors are raised to caller (e.g., another file is missing, or not a
+               database of this app), so a failure is never taken as "no difference".
+        """
+        if not os.path.exists(database):
+            raise IOError('No such file: %s' % database)  # or connecting would create it
+        if not DocBase.validate(database):
+            raise ValueError('Wrong database format: %s' % database)
+        DocBase(database, DocBase.FOREIGN_PROFILE).close()  # bring it up to date, so it has range hashes too
+        self._con.execute('ATTACH DATABASE ? AS that', (database,))
+        try:
+            self._con.execute('CREATE TEMP TABLE IF NOT EXISTS diff_ids (id INTEGER PRIMARY KEY)')
+            self._con.execute('DELETE FROM temp.diff_ids')
+            self._con.executemany('INSERT INTO temp.diff_ids VALUES(?)', [(i,) for i in self.diff_ids_()])
+            sql = 'SELECT id, title FROM %s.docs d WHERE id IN temp.diff_ids AND NOT EXISTS ' \
+                  '(SELECT 1 FROM %s.docs o WHERE o.digest=d.digest) ORDER BY id'
+            cur = self._con.cursor()
+            cur.execute(sql % ('main', 'that'))
+            mine = cur.fetchall()
+            cur.execute(sql % ('that', 'main'))
+            theirs = cur.fetchall()
+            self._con.commit()
+        except Exception as e:
+            self._con.rollback()
+            print('Error on comparison: %s' % e)
+            raise
+        finally:
+            self._con.execute('DETACH DATABASE that')
+        return mine, theirs
+
+    def diff_ids_(self):
+        """
+        compare range hashes of this database ("main") and the attached one ("that")
+        from top level down, only into buckets which differ.
+        @return array of ids whose leaves differ, or exist on one side only.
+        """
+        def hashes(schema, level, first, last):
+            cur = self._con.cursor()
+            cur.execute('SELECT bucket, hash FROM %s.merkle WHERE level=? AND bucket BETWEEN ? AND ? AND hash<>0'
+                        % schema, (level, first, last))
+            return dict(cur.fetchall())
+        def differ(a, b):
+            return sorted(i for i in set(a) | set(b) if a.get(i, 0) != b.get(i, 0))
+        bits = DocBase.MERKLE_BITS
+        level = DocBase.MERKLE_LEVELS
+        last = (1 << 63) - 1
+        pending = differ(hashes('main', level, 0, last), hashes('that', level, 0, last))
+        while level > 1 and len(pending) > 0:
+            level -= 1
+            children = []
+            for i in pending:
+                first, last = i << bits, ((i + 1) << bits) - 1
+                children.extend(differ(hashes('main', level, first, last), hashes('that', level, first, last)))
+            pending = children
+        ids = []
+        for i in pending:
+            first, last = i << bits, ((i + 1) << bits) - 1
+            leaves = []
+            for schema in ('main', 'that'):
+                cur = self._con.cursor()
+                cur.execute('SELECT id, leaf FROM %s.docs WHERE id BETWEEN ? AND ?' % schema, (first, last))
+                leaves.append(dict(cur.fetchall()))
+            ids.extend(differ(*leaves))
+        return ids
+
+
+class LazyBulk(object):
+    """
+    @note: images of a document, which are read from database on first access.
+    """
+    def __init__(self, database, sn):
+        self._db = database
+        self._sn = sn
+        self._value = None
+
+    @property
+    def loaded(self):
+        return self._value is not None
+
+    @property
+    def value(self):
+        """
+        @return bytes, see DocBase.read_bulk.
+        """
+        if self._value is None:
+            self._value = self._db.read_bulk(self._sn)
+        return self._value
+
+
+class BlobFile(object):
+    """
+    @note: file-like view of an incremental blob handle (sqlite3.Blob), which starts
+           after the codec header of value.
+    """
+    def __init__(self, blob, start):
+        self._blob = blob
+        self._start = start
+        blob.seek(start)
+
+    def read(self, size=-1):
+        return self._blob.read(size)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            offset += self._start
+        self._blob.seek(offset, whence)
+
+    def tell(self):
+        return self._blob.tell() - self._start
+
+    def close(self):
+        self._blob.close()
+
+
+class BulkBlob(object):
+    """
+    @note: images of one document, read or replaced one by one. If column "bulk" is
+           stored as it is (codec "none", or legacy FilePile), images are accessed by
+           incremental blob I/O (Connection.blobopen) at offsets in table of contents
+           of FilePile, so the whole pile is never in memory. A compressed one must be
+           decoded into memory, and its images are then views of it (no copy). So is
+           every one before Python 3.11, which has no Connection.blobopen.
+    """
+    CHUNK = 64 * 1024
+
+    def __init__(self, database, sn):
+        self._db = database
+        self._sn = sn
+        self._start = None  # offset of FilePile in blob, None if it's decoded in memory
+        self._fo = None
+        self._pile = None
+        self.open_()
+
+    def open_(self):
+        con = self._db._con
+        cur = con.cursor()
+        cur.execute('SELECT IFNULL(LENGTH(bulk), 0) FROM content WHERE id=?', (self._sn,))
+        size, = cur.fetchone()
+        if size == 0:
+            return  # no image
+        if hasattr(con, 'blobopen'):  # Python 3.11+
+            # head is read through blob handle: substr() in SQL would load the whole value
+            blob = con.blobopen('content', 'bulk', self._sn, readonly=True)
+            head = blob.read(3)
+            if head[0] == Codec.find('none').sn:
+                self._start = 1
+            elif head in (jex.FilePile.MAGIC_HEAD, jex.FilePile.MAGIC_HEAD2):
+                self._start = 0
+            if self._start is not None:
+                self._fo = BlobFile(blob, self._start)
+                try:
+                    self._pile = jex.FilePile(self._fo)
+                except Exception:
+                    self._fo.close()
+                    self._fo = None
+                    raise
+                return
+            blob.close()
+        bulk = self._db.read_bulk(self._sn)
+        self._fo = jex.BufferReader(bulk)
+        self._pile = jex.FilePile(bulk)
+
+    def close(self):
+        if self._pile is not None:
+            self._pile.close()
+            self._fo.close()
+        self._pile = None
+        self._fo = None
+
+    def names(self):
+        return [] if self._pile is None else self._pile.filenames()
+
+    def read(self, name):
+        """
+        @return bytes of one image, None if not found.
+        """
+        if self._pile is None or self._pile.locate(name) is None:
+            return None
+        return self._pile.read(name)
+
+    def view(self, name):
+        """
+        @return read-only memoryview of one image, None if not found. It's a slice of
+                decoded pile if bulk is compressed, so it costs no copy.
+        """
+        if self._pile is None or self._pile.locate(name) is None:
+            return None
+        return self._pile.view(name)
+
+    def md5(self):
+        """
+        @return md5 of the whole FilePile, read chunk by chunk.
+        """
+        m = hashlib.md5()
+        if isinstance(self._fo, jex.BufferReader):
+            m.update(self._fo.getbuffer())
+        elif self._fo is not None:
+            self._fo.seek(0)
+            chunk = self._fo.read(BulkBlob.CHUNK)
+            while len(chunk) > 0:
+                m.update(chunk)
+                chunk = self._fo.read(BulkBlob.CHUNK)
+        return m.digest()
+
+    def replace(self, name, data):
+        """
+        Replace one image. An image of the same size is overwritten in place, others
+        make the pile rewritten (as saving document does).
+        @return True if done.
+        """
+        piece = None if self._pile is None else self._pile.locate(name)
+        if piece is None:
+            return False
+        con = self._db._con
+        try:
+            if self._start is not None and piece.size == len(data):
+                # blob writes don't begin a transaction: without it, each one is committed
+                # by itself, and image, its crc32 and digest could be left out of step.
+                if not con.in_transaction:
+                    con.execute('BEGIN')
+                blob = con.blobopen('content', 'bulk', self._sn, readonly=False)
+                blob.seek(self._start + piece.offset)
+                blob.write(data)
+                if piece.crc_offset is not None:  # v2 pile has checksum of every image
+                    blob.seek(self._start + piece.crc_offset)
+                    blob.write(struct.pack('>I', zlib.crc32(data)))
+                blob.close()
+                self.close()
+                self.open_()
+                # derived data are kept by hand: digest (journal, version) and leaf (merkle)
+                text = self._db.read_text(self._sn).encode(encoding='utf-8')
+                digest = DocBase.digest_(hashlib.md5(text).digest(), self.md5())
+                con.execute('UPDATE docs SET digest=?, leaf=? WHERE id=?',
+                            (digest, DocBase.leaf_(self._sn, digest), self._sn))
+                con.commit()
+                return True
+            buf = io.BytesIO()
+            pile = jex.FilePile(buf, 'w')
+            for i in self.names():
+                pile.append(i, data if i == name else self.read(i))
+            pile.close()
+            self.close()
+            record = DBRecordDoc('', sn=self._sn)
+            record.bulk = buf.getvalue()
+            result = self._db.save_docs([record])
+            self.open_()
+            return result
+        except Exception as e:
+            con.rollback()
+            print('Error on update: %s' % e)
+            return False
+
+
+class DocWriter(object):
+    """
+    @note: saves documents on a background thread, which has its own connection to
+           database. So hashing, serializing, compression and disk writing never
+           block GUI thread. Jobs are done one by one in submitted order.
+    """
+    def __init__(self, database):
+        """
+        @param database: DocBase object, whose file and profile are used.
+        """
+        self._filename = database.source
+        self._profile = database.profile
+        self._jobs = queue.Queue()
+        self._thread = None
+
+    def submit(self, snapshots, done):
+        """
+        @param snapshots: array of tuple(DBRecordDoc, textual, binary). Records must not
+               be touched by caller until done, see DBRecordDoc.snapshot. "textual" is
+               a dict to be serialized into json; "binary" is bytes of images.
+        @param done: callback(bool), called on the background thread when the job is
+               finished. True if all documents are saved (in one transaction).
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run_, name='DocWriter', daemon=True)
+            self._thread.start()
+        self._jobs.put((snapshots, done))
+
+    def wait(self):
+        """
+        wait for all submitted jobs to finish, the thread keeps running.
+        """
+        self._jobs.join()
+
+    def close(self):
+        """
+        wait for all submitted jobs to finish, and stop the thread.
+        """
+        if self._thread is None:
+            return
+        self._jobs.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def run_(self):
+        store = DocBase(self._filename, self._profile)
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                break
+            snapshots, done = job
+            try:
+                for record, textual, binary in snapshots:
+                    record.bulk = binary
+                    record.script = json.dumps(textual)
+                result = store.save_docs([i[0] for i in snapshots])
+            except Exception as e:
+                print('Error on saving: %s' % e)
+                result = False
+            done(result)
+            self._jobs.task_done()
+        store.close()
+
+
+class DocSync(object):
+    """
+    @note: two-way sync of two databases. Documents are matched by uid. Their versions
+           are compared with the ones remembered at last sync (table "sync_state" of
+           both sides), so that a side knows what is changed, created or deleted since
+           then. Only new or changed documents are copied, one by one, and committed
+           in batches; a document changed on both sides is a conflict. Tags are matched
+           by path of names, missing ones are created (deletion of tag isn't synced).
+    """
+    def __init__(self, this, that, prefer=None, batch=32, progress=None):
+        """
+        @param this, that: DocBase objects.
+        @param prefer: None, 'this' or 'that'. A conflict is resolved by the preferred
+               side, or left untouched and reported if None.
+        @param progress: callback(int, int), number of done jobs and all jobs.
+        """
+        self._sides = (this, that)
+        self._prefer = prefer
+        self._batch = batch
+        self._progress = progress
+
+    def run(self):
+        """
+        @return dict: 'pushed', 'pulled', 'deleted' are numbers of documents copied to
+                that, copied to this and deleted (on either side); 'conflicts' is array
+                of tuple(uid, title) of the ones left untouched.
+        @note: without a former sync there's nothing remembered to compare with. So at
+               the first sync of two databases (e.g., one is a copy of the other file),
+               a document on one side only is copied to the other, even if it was deleted
+               there after copying; and a document which differs on both sides is a
+               conflict, even if it was edited on one side only. Sync right after copying
+               a file avoids both: then everything is remembered as the same.
+        """
+        this, that = self._sides
+        if this.uid == that.uid:
+            that.renew_uid_()
+        uids = (this.uid, that.uid)
+        self.sync_tags_()
+        docs = [self.load_docs_(i) for i in self._sides]
+        state = self.load_state_(this, uids[1])
+        self.pair_(docs, state)
+        jobs, conflicts = [], []
+        for uid in sorted(set(docs[0]) | set(docs[1]) | set(state)):
+            a, b, s = docs[0].get(uid), docs[1].get(uid), state.get(uid)
+            changed_a = a is not None and (s is None or a[2] != s[0])
+            changed_b = b is not None and (s is None or b[2] != s[1])
+            if a is None and b is None:
+                jobs.append(('forget', uid, None))
+            elif b is None:
+                jobs.append(('push', uid, a) if s is None else
+                            ('conflict', uid, a) if changed_a else ('delete-this', uid, a))
+            elif a is None:
+                jobs.append(('pull', uid, b) if s is None else
+                            ('conflict', uid, b) if changed_b else ('delete-that', uid, b))
+            elif self.same_(a, b):
+                if changed_a or changed_b:
+                    jobs.append(('agree', uid, (a, b)))
+            elif changed_a and changed_b:
+                jobs.append(('conflict', uid, a))
+            elif changed_a:
+                jobs.append(('push', uid, a))
+            elif changed_b:
+                jobs.append(('pull', uid, b))
+        result = {'pushed': 0, 'pulled': 0, 'deleted': 0, 'conflicts': conflicts}
+        try:
+            for n, (job, uid, row) in enumerate(jobs):
+                if job == 'conflict':
+                    a, b = docs[0].get(uid), docs[1].get(uid)
+                    if self._prefer == 'this':
+                        job = 'push' if a is not None else 'delete-that'
+                    elif self._prefer == 'that':
+                        job = 'pull' if b is not None else 'delete-this'
+                    else:
+                        conflicts.append((uid, row[3]))
+                        continue
+                if job == 'push':
+                    target = docs[1].get(uid)
+                    theirs = self.copy_(this, that, docs[0][uid], None if target is None else target[0])
+                    self.remember_(uid, docs[0][uid][2], theirs, uids)
+                    result['pushed'] += 1
+                elif job == 'pull':
+                    target = docs[0].get(uid)
+                    mine = self.copy_(that, this, docs[1][uid], None if target is None else target[0])
+                    self.remember_(uid, mine, docs[1][uid][2], uids)
+                    result['pulled'] += 1
+                elif job == 'delete-this' or job == 'delete-that':
+                    side = this if job == 'delete-this' else that
+                    side.delete_doc_(row[0])
+                    self.remember_(uid, None, None, uids)
+                    result['deleted'] += 1
+                elif job == 'agree':
+                    a, b = row
+                    self.remember_(uid, a[2], b[2], uids)
+                elif job == 'forget':
+                    self.remember_(uid, None, None, uids)
+                if (n + 1) % self._batch == 0:
+                    self.commit_(n + 1, len(jobs))
+            self.commit_(len(jobs), len(jobs))
+        except Exception as e:
+            for side in self._sides:
+                side._con.rollback()
+            print('Error on sync: %s' % e)
+            result['error'] = str(e)
+        return result
+
+    def pair_(self, docs, state):
+        """
+        Documents never synced but on both sides have different uids, e.g., databases
+        upgraded separately, or documents copied by copy_docs. They are paired only by
+        content (title and digest), never by id, which is given by each database on
+        its own. That side takes uid of this side. A document edited after it was
+        copied isn't paired, so both versions are kept (copied to each other).
+        """
+        that = self._sides[1]
+        key = lambda r: (r[3], bytes(r[7] or b''))
+        unpaired = dict((key(r), r) for u, r in docs[1].items() if u not in docs[0] and u not in state)
+        for uid, row in list(docs[0].items()):
+            if uid in docs[1] or uid in state:
+                continue
+            other = unpaired.pop(key(row), None)
+            if other is None:
+                continue
+            that._con.execute('UPDATE docs SET uid=? WHERE id=?', (uid, other[0]))
+            del docs[1][other[1]]
+            docs[1][uid] = (other[0], uid) + other[2:]
+        that._con.commit()
+
+    def commit_(self, done, total):
+        for side in self._sides:
+            side._con.commit()
+        if self._progress is not None:
+            self._progress(done, total)
+
+    def sync_tags_(self):
+        """
+        create tags missing on either side, parents before children.
+        """
+        this, that = self._sides
+        for source, target in ((this, that), (that, this)):
+            for root in source.get_all_tags():
+                for sn in root.all_family():  # pre-order
+                    target.tag_by_path(source.tag_path(source.find_tag(sn)), create=True)
+
+    @staticmethod
+    def load_docs_(database):
+        """
+        @return dict: uid --> tuple(id, uid, version, title, tags, date, date2, digest).
+                Only metadata are loaded, no content.
+        """
+        cur = database._con.cursor()
+        cur.execute('SELECT id, uid, version, title, tags, date, date2, digest FROM docs')
+        return dict((row[1], row) for row in cur.fetchall())
+
+    @staticmethod
+    def load_state_(database, peer):
+        """
+        @return dict: uid --> tuple(version here, version in peer) at last sync.
+        """
+        cur = database._con.cursor()
+        cur.execute('SELECT uid, mine, theirs FROM sync_state WHERE peer=?', (peer,))
+        return dict((u, (m, t)) for u, m, t in cur.fetchall())
+
+    def remember_(self, uid, mine, theirs, uids):
+        """
+        record versions of both sides in both databases; None means deleted.
+        """
+        this, that = self._sides
+        for side, peer, versions in ((this, uids[1], (mine, theirs)), (that, uids[0], (theirs, mine))):
+            if mine is None:
+                side._con.execute('DELETE FROM sync_state WHERE peer=? AND uid=?', (peer, uid))
+            else:
+                side._con.execute('INSERT OR REPLACE INTO sync_state VALUES(?,?,?,?)', (peer, uid) + versions)
+
+    def same_(self, a, b):
+        """
+        @return True if two rows have the same title, dates, content and tags.
+        """
+        this, that = self._sides
+        if a[3] != b[3] or a[5] != b[5] or a[6] != b[6] or bytes(a[7] or b'') != bytes(b[7] or b''):
+            return False
+        return self.tag_paths_(this, a[4]) == self.tag_paths_(that, b[4])
+
+    @staticmethod
+    def tag_paths_(database, tags_str):
+        tags = [] if tags_str in (None, '') else [database.find_tag(int(i)) for i in tags_str.split(',')]
+        return sorted(database.tag_path(i) for i in tags if i is not None)
+
+    def copy_(self, source, target, row, target_sn):
+        """
+        copy a document, whose content is loaded now (only this one).
+        @return its version in target.
+        """
+        sn, uid, version, title, tags, date, date2, digest = row
+        cur = source._con.cursor()
+        cur.execute('SELECT text, bulk FROM content WHERE id=?', (sn,))
+        text, bulk = cur.fetchone()
+        paths = DocSync.tag_paths_(source, tags)
+        record = DBRecordDoc(title, tags=[target.tag_by_path(i, create=True) for i in paths],
+                             date=date, date2=date2, sn=0 if target_sn is None else target_sn)
+        record.script = source.decode_text_(text)
+        text = DocSync.portable_(source, target, text)
+        bulk = DocSync.portable_(source, target, bulk)
+        return target.put_doc_(record, uid, text, bulk, digest)
+
+    @staticmethod
+    def portable_(source, target, value):
+        """
+        an encoded value is copied as it is, unless its codec depends on the database
+        (preset dictionary), then it's encoded again for target.
+        """
+        if value is None:
+            return sqlite3.Binary(b'')
+        codec = Codec.of(value)
+        if codec is None or codec.name != 'zdict':
+            return value
+        return target.encode_('text', source.decode_(value))  # only text uses it, see CodecPolicy
@@ -10,6 +10,7 @@ import functools
 import io
 import struct
 import sys
+import zlib
 from sys import platform
 
 
@@ -175,6 +176,48 @@ def returns(valid_type):
     return decorator
 
 
+class BufferReader:
+    """
+    A read-only file object over a buffer (bytes, memoryview, mmap...) without copying
+    it, unlike io.BytesIO which copies anything but bytes. Only what is read is copied.
+    """
+    def __init__(self, buf):
+        self._buf = memoryview(buf).cast('B')
+        self._pos = 0
+
+    def read(self, size=-1):
+        end = len(self._buf) if size is None or size < 0 else min(self._pos + size, len(self._buf))
+        data = self._buf[self._pos:end].tobytes()
+        self._pos = max(end, self._pos)
+        return data
+
+    def readinto(self, b):
+        data = self._buf[self._pos:self._pos + len(b)]
+        b[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += len(self._buf)
+        if offset < 0:
+            raise ValueError('negative seek position %d' % offset)
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def getbuffer(self):
+        return self._buf
+
+    def close(self):
+        self._buf = memoryview(b'')
+        self._pos = 0
+
+
 class FilePile:
     """
     Purpose:
@@ -183,8 +226,22 @@ class FilePile:
       It leads to many useless / redundant database writing commit.
       So I have to make one by myself.
       This class only put a few files together into one big file.
+    Layouts:
+      v1: MAGIC_HEAD, then (TLV of filename, TLV of content) for every file. Reading
+          must scan all of them.
+      v2: MAGIC_HEAD2, contents of files one after another, index, footer. The index
+          has (filename, offset, size, crc32) of every file; the footer has fixed size
+          at the end, telling where the index is. So reading seeks to footer, then to
+          index, no matter how many files there are. New piles are written in v2.
+    Reading from a buffer (bytes, memoryview, mmap) instead of a file object, files in
+    pile are memoryview slices of it: nothing is copied. Keep the buffer alive (and mmap
+    open) while they are used.
     """
     MAGIC_HEAD = b'jxd'
+    MAGIC_HEAD2 = b'jx2'
+    MAGIC_FOOTER = b'jx2i'
+    FOOTER = '>QII4s'  # offset of index, size of index, number of files, MAGIC_FOOTER
+    ENTRY = '>H%dsQQI'  # length of filename, filename, offset, size, crc32
     #
     TYPE_FILENAME = 0
     TYPE_CONTENT = 1
@@ -193,44 +250,97 @@ class FilePile:
         """
         A FilePiece represents an independent file embedded in FilePile.
         """
-        def __init__(self, name, offset, size):
+        def __init__(self, name, offset, size, crc=None, crc_offset=None):
             self.filename = name
             self.offset = offset
             self.size = size
+            self.crc = crc                # v2 only
+            self.crc_offset = crc_offset  # v2 only, where crc is stored in pile
 
-    def __init__(self, fo, mode='r'):
+    def __init__(self, fo, mode='r', version=2):
         if mode not in ('r', 'w'):
             raise RuntimeError('Only "w" or "r" supported.')
         #
-        if mode == 'r':
-            head = fo.read(3)
-            if head != FilePile.MAGIC_HEAD:
-                raise ValueError('Wrong file format')
-        #
         self._mode = mode
         self._fo = fo
+        self._buf = None  # read-only memoryview if pile is read from a buffer
+        self._files = {}  # filename --> FilePiece, in order of appending
         #
         if mode == 'r':
-            self._file_list = self.build_file_list_()
+            try:  # a buffer? (mmap has "read" too, so it's told by buffer protocol)
+                self._buf = memoryview(fo).cast('B').toreadonly()
+                self._fo = BufferReader(self._buf)
+            except TypeError:
+                pass  # file object
+            head = self._fo.read(3)
+            if head == FilePile.MAGIC_HEAD:
+                self._version = 1
+                self._files = dict((i.filename, i) for i in self.build_file_list_())
+            elif head == FilePile.MAGIC_HEAD2:
+                self._version = 2
+                self._files = self.read_index_()
+            else:
+                raise ValueError('Wrong file format')
         else:
-            self._fo.write(FilePile.MAGIC_HEAD)
+            self._version = version
+            self._fo.write(FilePile.MAGIC_HEAD if version == 1 else FilePile.MAGIC_HEAD2)
+            self._offset = len(FilePile.MAGIC_HEAD)
+
+    @property
+    def version(self):
+        return self._version
 
     def open(self, filename):
         """
-        @return io.BytesIO object
+        @return file object: BufferReader if pile is read from a buffer, else io.BytesIO.
+        """
+        content = self.view(filename)
+        if self._buf is None:
+            return io.BytesIO(content.obj)
+        return BufferReader(content)
+
+    def view(self, filename):
+        """
+        @return read-only memoryview of file, a slice of buffer if pile is read from one.
+        """
+        i = self.locate(filename)
+        if i is None:
+            raise RuntimeError('File %s not found' % filename)
+        if self._buf is None:
+            self._fo.seek(i.offset)
+            content = memoryview(self._fo.read(i.size))
+        else:
+            content = self._buf[i.offset:i.offset + i.size]
+        if i.crc is not None and zlib.crc32(content) != i.crc:
+            raise RuntimeError('File %s is broken' % filename)
+        return content
+
+    def read(self, filename):
+        """
+        @return bytes of file.
+        """
+        content = self.view(filename)
+        return content.obj if self._buf is None else content.tobytes()
+
+    def locate(self, filename):
+        """
+        @return FilePiece object (offset and size of file in pile), None if not found.
         """
         if self._mode != 'r':
             raise RuntimeError('Only "r" mode supports open.')
-        for i in self._file_list:
-            if i.filename == filename:
-                self._fo.seek(i.offset)
-                content = self._fo.read(i.size)
-                return io.BytesIO(content)
-        raise RuntimeError('File %s not found' % filename)
+        return self._files.get(filename, None)
+
+    def filenames(self):
+        return list(self._files.keys())
 
     def append(self, filename, content):
         if self._mode != 'w':
             raise RuntimeError('Only "w" mode supports append.')
+        if self._version == 2:
+            self._fo.write(content)
+            self._files[filename] = FilePile.FilePiece(filename, self._offset, len(content), zlib.crc32(content))
+            self._offset += len(content)
+            return
         filename = filename.encode(encoding='utf-8')
         length = len(filename)
         tlv = struct.pack('>BI%ds' % length, FilePile.TYPE_FILENAME, length, filename)
@@ -241,18 +351,53 @@ class FilePile:
 
     def close(self):
         if self._mode == 'w':
+            if self._version == 2:
+                self.write_index_()
             self._fo.flush()
         self._fo = None
+        self._buf = None  # views given out stay valid
+
+    def __len__(self):
+        return len(self._files)
+
+    def write_index_(self):
+        index = []
+        for i in self._files.values():
+            name = i.filename.encode(encoding='utf-8')
+            index.append(struct.pack(FilePile.ENTRY % len(name), len(name), name, i.offset, i.size, i.crc))
+        index = b''.join(index)
+        self._fo.write(index)
+        self._fo.write(struct.pack(FilePile.FOOTER, self._offset, len(index), len(self._files), FilePile.MAGIC_FOOTER))
+
+    def read_index_(self):
+        """
+        For v2: read footer, then the whole index at once.
+        """
+        size = struct.calcsize(FilePile.FOOTER)
+        self._fo.seek(-size, 2)
+        offset, length, count, magic = struct.unpack(FilePile.FOOTER, self._fo.read(size))
+        if magic != FilePile.MAGIC_FOOTER:
+            raise ValueError('Wrong file format')
+        self._fo.seek(offset)
+        index = self._fo.read(length)
+        files, pos = {}, 0
+        for _ in range(count):
+            length, = struct.unpack_from('>H', index, pos)
+            name, start, size, crc = struct.unpack_from(FilePile.ENTRY % length, index, pos)[1:]
+            name = bytes(name).decode(encoding='utf-8')
+            pos += struct.calcsize(FilePile.ENTRY % length)
+            files[name] = FilePile.FilePiece(name, start, size, crc, offset + pos - 4)
+        return files
 
     def build_file_list_(self):
         """
-        For 'read' purpose, scan whole FilePile to build a list beforehand as index.
+        For v1 'read' purpose, scan whole FilePile to build a list beforehand as index.
         """
         try:
             file_list = []
             error = RuntimeError('Wrong file format')
             tl = self._fo.read(5)  # tag (one byte) + length (4 bytes)
-            while tl != '':
+            while len(tl) == 5:
                 tag, length = struct.unpack('>BI', tl)
                 if tag != FilePile.TYPE_FILENAME:
                     raise error
@@ -1429,7 +1429,7 @@ class ImageBox(tk.Canvas, StorageMixin):
     def __init__(self, master, *a, **kw):
         """
         keyword arguments:
-          image: file object. Required.
+          image: file object (io.BytesIO, jex.BufferReader...). Required.
           ext: str, filename extension. Required.
           scale: integer, 0~100. Optional. 100 is default value.
         @note: keep file object alive while ImageBox alive except you don't use 'export_to_file' method
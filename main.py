@@ -27,6 +27,8 @@ from PIL import Image, ImageTk
 from sys import platform
 import json
 import io
+import queue
+import hashlib
 
 DATE_FORMAT = '%Y-%m-%d'  # e.g., 2019-03-18
 
@@ -89,9 +91,11 @@ class TagPicker(tk.Frame):
         e.bind('<Return>', self.on_query_)
         #
         # display all tags in a tree
-        self._tree = ttk.Treeview(master, columns='sn', displaycolumns=[],
+        self._tree = ttk.Treeview(master, columns=('sn', 'docs'), displaycolumns=['docs'],
                                   show='tree',  # three options: '<Empty>', 'headings', 'tree'
                                   selectmode='browse')
+        self._tree.column('docs', width=60, anchor=tk.E, stretch=False)  # documents using tag
+        self._usage = self._store.tag_usage()
         self._tree.pack(side=tk.TOP, fill=tk.BOTH, expand=tk.YES)
         self._tree.bind(jex.mouse_right_button(), self.on_popup_menu_)
         self._tree.bind('<Double-1>', self.select_tag_)
@@ -176,9 +180,9 @@ class TagPicker(tk.Frame):
         target = self.tag_from_node_(selection)
         # replace coarse with more specific one
         for i in self._selected[:]:
-            if target.find(i.sn) is not None:  # same or i is descendant of target
+            if target.contains(i):  # same or i is descendant of target
                 return
-            if i.find(target.sn) is not None:  # target is better than i
+            if i.contains(target):  # target is better than i
                 self._selected.remove(i)
                 break
         self._selected.append(target)
@@ -196,15 +200,15 @@ class TagPicker(tk.Frame):
                 return
 
     def draw_tags_(self, parent, tag):
-        iid = self._tree.insert(parent, tk.END, text=tag.name, values=tag.sn, tags='node')
+        total = self._usage.get(tag.sn, (0, 0))[1]
+        iid = self._tree.insert(parent, tk.END, text=tag.name, values=(tag.sn, total), tags='node')
         for i in tag.children:
             self.draw_tags_(iid, i)
 
     def add_root_(self):
         tag = jdb.DBRecordTag(TagPicker.UNNAMED)
         self._store.insert_tag(tag)
-        self._tags.append(tag)
-        iid = self._tree.insert('', tk.END, text=TagPicker.UNNAMED, values=tag.sn, tags='node', open=True)
+        iid = self._tree.insert('', tk.END, text=TagPicker.UNNAMED, values=(tag.sn, 0), tags='node', open=True)
         self.schedule_show_rename_entry(iid)
 
     def del_node_(self):
@@ -213,7 +217,6 @@ class TagPicker(tk.Frame):
         if self._store.check_use(tag) > 0:
             tkMessageBox.showerror(MainApp.TITLE, '%s\nis in use\nand cannot be removed.' % tag.name)
             return
-        jdb.DBRecordTag.forest_delete(self._tags, tag)
         self._store.delete_tag(tag)
         self._tree.delete(iid)
 
@@ -221,10 +224,8 @@ class TagPicker(tk.Frame):
         iid = self._tree.focus()
         selected_tag = self.tag_from_node_(iid)
         tag = jdb.DBRecordTag(TagPicker.UNNAMED, selected_tag.sn)
-        jdb.DBRecordTag.forest_add(self._tags, tag)
         self._store.insert_tag(tag)
-        selected_tag.add_child(tag)
-        child = self._tree.insert(iid, tk.END, text=TagPicker.UNNAMED, values=tag.sn, tags='node', open=True)
+        child = self._tree.insert(iid, tk.END, text=TagPicker.UNNAMED, values=(tag.sn, 0), tags='node', open=True)
         self.schedule_show_rename_entry(child)
 
     def schedule_show_rename_entry(self, iid):
@@ -261,7 +262,7 @@ class TagPicker(tk.Frame):
         """
         sn = self._tree.item(iid, 'values')
         sn = int(sn[0])
-        return jdb.DBRecordTag.forest_find(self._tags, sn)
+        return self._store.find_tag(sn)
 
     def get_selection(self):
         return self._selected
@@ -273,19 +274,28 @@ class TagPicker(tk.Frame):
     def move_item_end_(self, parent):
         # 1. visual effect
         self._tree.move(self._moved_node, parent, len(self._tree.get_children(parent)))
-        # 2. data structure
+        # 2. data structure and database
         moved = self.tag_from_node_(self._moved_node)
-        jdb.DBRecordTag.forest_delete(self._tags, moved)
         if parent == '':
-            moved.parent = 0
+            self._store.move_tag(moved, 0)
         else:
             parent = self._tree.item(parent, 'values')
-            moved.parent = int(parent[0])
-        jdb.DBRecordTag.forest_add(self._tags, moved)
-        # 3. database
-        self._store.update_tag(moved)
-        # 4. misc
+            self._store.move_tag(moved, int(parent[0]))
+        # 3. misc
         self._moved_node = None
+        self.refresh_usage_()
+
+    def refresh_usage_(self):
+        """
+        counts of ancestors change when a tag is moved.
+        """
+        self._usage = self._store.tag_usage()
+        nodes = list(self._tree.get_children(''))
+        while len(nodes) > 0:
+            iid = nodes.pop()
+            sn = int(self._tree.item(iid, 'values')[0])
+            self._tree.set(iid, 'docs', self._usage.get(sn, (0, 0))[1])
+            nodes.extend(self._tree.get_children(iid))
 
     def move_ok_(self, parent):
         if self._tree.parent(self._moved_node) == parent:
@@ -295,7 +305,7 @@ class TagPicker(tk.Frame):
         moved = self.tag_from_node_(self._moved_node)
         static = self._tree.item(parent, 'values')
         static = int(static[0])
-        if moved.find(static):
+        if moved.contains(self._store.find_tag(static)):
             return False  # node can't be moved to its descendant.
         return True
 
@@ -653,8 +663,7 @@ class NotePreview:
         #
         tk.Label(top, text='Size: %d B' % note.size).pack(side=tk.TOP, anchor=tk.W)
         #
-        content, _ = database.read_doc(note.sn)
-        content = json.loads(content).pop("text", '')
+        content = database.read_plain(note.sn)
         limit = NotePreview.LINE_WIDTH * NotePreview.LINES_MAX
         lines = content[:limit].split('\n')[:NotePreview.LINES_MAX]
         option = {'width': NotePreview.LINE_WIDTH, 'height': NotePreview.LINES_MAX}
@@ -728,22 +737,37 @@ class OpenDocDlg(jtk.ModalDialog):
     SORT_BY_SIZE = 3
     SORT_COUNT = 4
     """
-    @return a tuple(array of serial number, array of DBRecordDoc, current page)
+    @return a tuple(array of selected StatedDoc, QueryConfig of this search)
     """
 
     class QueryConfig(object):
         def __init__(self):
-            self._hits = []
+            self._cursor = None  # jdb.DocCursor, fetching hits page by page
+            self._docs = []      # StatedDoc objects on current page
             self._curr_page = 0
             self._sort_states = [False] * OpenDocDlg.SORT_COUNT
 
         @property
-        def hits(self):
-            return self._hits
+        def cursor(self):
+            return self._cursor
+
+        @cursor.setter
+        def cursor(self, value):
+            self._cursor = value
+
+        @property
+        def docs(self):
+            return self._docs
 
-        @hits.setter
-        def hits(self, value):
-            self._hits[:] = value
+        def count(self):
+            return 0 if self._cursor is None else self._cursor.count()
+
+        def refresh(self):
+            """
+            hits may be changed because of deletion.
+            """
+            if self._cursor is not None:
+                self._cursor.refresh()
 
         @property
         def page(self):
@@ -760,7 +784,8 @@ class OpenDocDlg(jtk.ModalDialog):
             self._sort_states[index] = not self._sort_states[index]
 
         def clear(self):
-            del self._hits[:]
+            self._cursor = None
+            del self._docs[:]
             self._curr_page = 0
             self._sort_states[:] = [False] * OpenDocDlg.SORT_COUNT
 
@@ -772,8 +797,8 @@ class OpenDocDlg(jtk.ModalDialog):
         kw['title'] = 'Select Document to Open'
         jtk.ModalDialog.__init__(self, master, *a, **kw)
         # jump to the page of lastly opened time
-        if len(self._state.hits) > 0:
-            self.jump_page_(self._state.page)
+        if self._state.count() > 0:
+            self.jump_page_(min(self._state.page, self.pages_() - 1))
         self._preview = None
 
     def body(self, master):
@@ -835,7 +860,7 @@ class OpenDocDlg(jtk.ModalDialog):
     def apply(self):
         try:
             selected = self._note_list.selection()
-            selected = [int(i) + self._state.page * OpenDocDlg.PAGE_NUM for i in selected]
+            selected = [self._state.docs[int(i)] for i in selected]
             self.result = (selected, self._state)
         except:
             self.result = None
@@ -864,11 +889,11 @@ class OpenDocDlg(jtk.ModalDialog):
     def jump_page_(self, n):
         # update page progress
         self._note_list.delete(*self._note_list.get_children(''))
-        start = n * OpenDocDlg.PAGE_NUM
-        stop = start + OpenDocDlg.PAGE_NUM
-        for i, j in enumerate(self._state.hits[start:stop]):
+        docs = [] if self._state.cursor is None else self._state.cursor.page(n)
+        self._state.docs[:] = [StatedDoc.from_db(i) for i in docs]
+        for i, j in enumerate(self._state.docs):
             self._note_list.insert('', tk.END, iid=str(i), values=[j.sn, j.title, j.date_created, j.date_modified, self.intuitive_nb_str(j.size)])
-        if len(self._state.hits) > 0:
+        if len(self._state.docs) > 0:
             self._note_list.selection_set('0')  # automatically select the 1st one
             self._note_list.focus('0')  # give the 1st one focus (visually)
             self._note_list.focus_set()  # widget get focus to accept '<space>', '<Up>', '<Down>'
@@ -885,17 +910,16 @@ class OpenDocDlg(jtk.ModalDialog):
             self.jump_page_(self._state.page - 1)
 
     def pages_(self):
-        total = max(len(self._state.hits), 1)
-        return (total - 1) // OpenDocDlg.PAGE_NUM + 1  # [Python 3x] floored divide: "//"
+        if self._state.cursor is None:
+            return 1
+        return self._state.cursor.pages()
 
     def search_(self, evt=None):
         conditions = {}
         if self._sb_tit.enabled():
             keywords = self._sb_tit.get_result()
             if len(keywords) > 0:
-                keywords[:] = ['"%%%s%%"' % i for i in keywords]
-                latter = ' AND title LIKE '.join(keywords)
-                conditions['title'] = 'title LIKE %s' % latter
+                conditions['title'] = keywords
         if self._sb_tag.enabled():
             tags = self._sb_tag.get_result()
             if len(tags) > 0:
@@ -916,12 +940,10 @@ class OpenDocDlg(jtk.ModalDialog):
             keywords = self._sb_txt.get_result()
             if len(keywords) > 0:
                 conditions['content'] = keywords
-        if len(conditions) == 0:
-            self._state.clear()
-        else:
-            docs = self._store.select_doc(**conditions)
-            self._state.hits[:] = [StatedDoc.from_db(i) for i in docs]
-        jtk.MessageBubble(self._btn_search, '%d found' % len(self._state.hits))
+        self._state.clear()
+        if len(conditions) > 0:
+            self._state.cursor = self._store.query_doc(OpenDocDlg.PAGE_NUM, **conditions)
+        jtk.MessageBubble(self._btn_search, '%d found' % self._state.count())
         self.jump_page_(0)
 
     def open_preview_(self, evt=None):
@@ -932,29 +954,27 @@ class OpenDocDlg(jtk.ModalDialog):
         if active == '':
             return
         index = self._note_list.index(active)
-        index += self._state.page * OpenDocDlg.PAGE_NUM
         if self._preview is not None:
             self._preview.close()
-        self._preview = NotePreview(self, database=self._store, note=self._state.hits[index])
+        self._preview = NotePreview(self, database=self._store, note=self._state.docs[index])
 
     def sort_by_id_(self):
-        self._state.sort_switch(OpenDocDlg.SORT_BY_ID)
-        self._state.hits.sort(key=lambda i: i.sn, reverse=self._state.sort_state(OpenDocDlg.SORT_BY_ID))
-        self.jump_page_(0)
+        self.sort_by_('id', OpenDocDlg.SORT_BY_ID)
 
     def sort_by_date_(self):
-        self._state.sort_switch(OpenDocDlg.SORT_BY_DATE_CREATE)
-        self._state.hits.sort(key=lambda i: i.date_created, reverse=self._state.sort_state(OpenDocDlg.SORT_BY_DATE_CREATE))
-        self.jump_page_(0)
+        self.sort_by_('date', OpenDocDlg.SORT_BY_DATE_CREATE)
 
     def sort_by_date2_(self):
-        self._state.sort_switch(OpenDocDlg.SORT_BY_DATE_MODIFY)
-        self._state.hits.sort(key=lambda i: i.date_modified, reverse=self._state.sort_state(OpenDocDlg.SORT_BY_DATE_MODIFY))
-        self.jump_page_(0)
+        self.sort_by_('date2', OpenDocDlg.SORT_BY_DATE_MODIFY)
 
     def sort_by_size_(self):
-        self._state.sort_switch(OpenDocDlg.SORT_BY_SIZE)
-        self._state.hits.sort(key=lambda i: i.size, reverse=self._state.sort_state(OpenDocDlg.SORT_BY_SIZE))
+        self.sort_by_('size', OpenDocDlg.SORT_BY_SIZE)
+
+    def sort_by_(self, key, index):
+        if self._state.cursor is None:
+            return
+        self._state.sort_switch(index)
+        self._state.cursor.sort(key, self._state.sort_state(index))
         self.jump_page_(0)
 
     def loop_tab_next_(self, evt=None):
@@ -1312,13 +1332,11 @@ class DocCompareDlg(jtk.ModalDialog):
         if not jdb.DocBase.validate(database):
             tkMessageBox.showerror(MainApp.TITLE, 'Database format is different!')
             return
-        this_hashes = self._this_database.get_hashes()
-        that_hashes = jdb.DocBase(database).get_hashes()
-        h1 = set([d for s, t, d in this_hashes])
-        h2 = set([d for s, t, d in that_hashes])
-        common = h1.intersection(h2)
-        this_docs = [(sn, title) for sn, title, digest in this_hashes if digest not in common]
-        that_docs = [(sn, title) for sn, title, digest in that_hashes if digest not in common]
+        try:
+            this_docs, that_docs = self._this_database.compare_docs(database)
+        except Exception as e:
+            tkMessageBox.showerror(MainApp.TITLE, 'Failed to compare:\n%s' % e)
+            return
         self._tv1.delete(*self._tv1.get_children())
         for doc in this_docs:
             self._tv1.insert('', tk.END, values=(doc[0], doc[1]))
@@ -1339,11 +1357,12 @@ class MenuId(IntEnum):
     DOC_NEW = 0
     DOC_OPEN = 1
     DOC_SAVE = 2
-    DOC_CLOSE = 3
-    DOC_DELETE = 4
-    DOC_EXPORT_HTML = 5
-    DOC_COPY_DB = 6
-    DOC_COMPARE_DB = 7
+    DOC_SAVE_ALL = 3
+    DOC_CLOSE = 4
+    DOC_DELETE = 5
+    DOC_EXPORT_HTML = 6
+    DOC_COPY_DB = 7
+    DOC_COMPARE_DB = 8
 
     # 数字不连续是因为分隔符的存在
     EDIT_IMAGE = 0
@@ -1396,6 +1415,8 @@ class MainApp(tk.Tk):
     else:
         RELY = jex.enum1(DB=0, DOC=1)
 
+    SAVING_POLL = 100  # milliseconds, interval to check if background saving finished
+
     EVENT_DB_EXIST = '<<DBExist>>'  # sent when database is opened / closed.
     EVENT_DOC_EXIST = '<<DocExist>>'  # sent when first document opened / last document closed.
 
@@ -1426,6 +1447,8 @@ class MainApp(tk.Tk):
         self.add_listener(menu, MainApp.EVENT_DB_EXIST, MenuId.DOC_OPEN)
         menu.add_command(label='Save', command=self.menu_doc_save_)
         self.add_listener(menu, MainApp.EVENT_DOC_EXIST, MenuId.DOC_SAVE)
+        menu.add_command(label='Save All', command=self.menu_doc_save_all_)
+        self.add_listener(menu, MainApp.EVENT_DOC_EXIST, MenuId.DOC_SAVE_ALL)
         menu.add_command(label='Close', command=self.menu_doc_close_)
         self.add_listener(menu, MainApp.EVENT_DOC_EXIST, MenuId.DOC_CLOSE)
         menu.add_command(label='Delete', command=self.menu_doc_delete_)
@@ -1618,6 +1641,8 @@ class MainApp(tk.Tk):
         sub.pack(side=tk.BOTTOM, fill=tk.BOTH, expand=tk.NO)
         w = ttk.Sizegrip(sub)
         w.pack(side=tk.RIGHT, fill=tk.BOTH, expand=tk.NO)
+        self._status = tk.StringVar()
+        tk.Label(sub, textvariable=self._status).pack(side=tk.LEFT)
 
     def menu_database_new_(self):
         filename = tkFileDialog.asksaveasfilename(defaultextension='.sqlite3')
@@ -1626,7 +1651,12 @@ class MainApp(tk.Tk):
         if os.path.exists(filename):
             tkMessageBox.showinfo(MainApp.TITLE, 'Please delete it in File Explorer')
             return
-        self._store = jdb.DocBase.create_db(filename)
+        store = jdb.DocBase.create_db(filename)
+        if store is None:
+            tkMessageBox.showerror(MainApp.TITLE, 'Failed to create database')
+            return
+        self._store = store
+        self._writer = jdb.DocWriter(self._store)
         self._last_search = None
         self.event_generate(MainApp.EVENT_DB_EXIST, state=1)
         self.title('[%s] %s' % (MainApp.TITLE, os.path.basename(filename)))
@@ -1646,7 +1676,12 @@ class MainApp(tk.Tk):
             return
         if not self.menu_database_close_():
             return
-        self._store = jdb.DocBase(filename)
+        try:
+            self._store = jdb.DocBase(filename)
+        except Exception as e:  # e.g., it can't be upgraded by this SQLite
+            tkMessageBox.showerror(MainApp.TITLE, str(e))
+            return
+        self._writer = jdb.DocWriter(self._store)
         self._last_search = None
         self.event_generate(MainApp.EVENT_DB_EXIST, state=1)
         self.title('[%s] %s' % (MainApp.TITLE, os.path.basename(filename)))
@@ -1659,13 +1694,14 @@ class MainApp(tk.Tk):
             if choice is None:  # cancel
                 return False
             if choice is True:
-                for e in self._editor.iter_tabs():
-                    if e.modified():
-                        self.save_(e)
+                self.save_all_()
+        self.wait_saving_()
+        self._writer.close()
         self._editor.close_all()
         self._notes.clear()
         self._store.close()
         self._store = None
+        self._writer = None
         self.event_generate(MainApp.EVENT_DOC_EXIST, state=0)
         self.event_generate(MainApp.EVENT_DB_EXIST, state=0)
         self.title(MainApp.TITLE)
@@ -1692,15 +1728,13 @@ class MainApp(tk.Tk):
         dlg = OpenDocDlg(self, database=self._store, state=self._last_search)
         if dlg.show() is False:
             return
-        indices, self._last_search = dlg.result
+        notes, self._last_search = dlg.result
         opened = {n: e for e, n in self._notes.items()}
-        for i in indices:
-            note = self._last_search.hits[i]
-            # self._last_search.hits may contains the same doc to the ones in self._notes.
+        for note in notes:
+            # the hits may contains the same doc to the ones in self._notes.
             # we replace the new doc with the old one, which has newer digests.
             for old_note in opened:
                 if old_note.sn == note.sn and old_note != note:
-                    self._last_search.hits[i] = old_note
                     note = old_note
                     break
             # activate the editor opened previously
@@ -1726,6 +1760,91 @@ class MainApp(tk.Tk):
         self.save_(editor)
 
     def save_(self, editor):
+        errors, record, textual, binary = self.stage_(editor)
+        if MainApp.SAVE.FailContent in errors:
+            return errors
+        #
+        # save everything to database
+        self.submit_saving_([(editor, record, textual, binary)])
+        errors.add(MainApp.SAVE.Finish)
+        return errors
+
+    def menu_doc_save_all_(self, evt=None):
+        self.save_all_()
+
+    def save_all_(self):
+        """
+        save all modified documents in one database transaction.
+        """
+        staged = []
+        for editor in self._editor.iter_tabs():
+            if not editor.modified():
+                continue
+            errors, record, textual, binary = self.stage_(editor)
+            if MainApp.SAVE.FailContent not in errors:
+                staged.append((editor, record, textual, binary))
+        if len(staged) > 0:
+            self.submit_saving_(staged)
+
+    def submit_saving_(self, staged):
+        """
+        Only a snapshot of content is taken on GUI thread. The rest (serializing,
+        hashing, compression and writing) is done in background by DocWriter.
+        Writer saves copies of records, which may be changed by GUI meanwhile.
+        @param staged: array of tuple(editor, record, textual, binary)
+        """
+        if self._saving > 0 and any(i[1].fragile for i in staged):
+            self.wait_saving_()  # a new doc in saving gets its sn first, so it's inserted once
+        jobs, snapshots = [], []
+        for editor, record, textual, binary in staged:
+            self._notes[editor] = record
+            editor.on_saved()  # if user edits during saving, it becomes modified again.
+            copy = record.snapshot()
+            jobs.append((editor, record, copy, set(copy.unsaved_fields)))
+            snapshots.append((copy, textual, binary))
+        self._writer.submit(snapshots, lambda ok: self._saved.put((ok, jobs)))
+        self._saving += 1
+        self._status.set('saving...')
+        if self._saving == 1:
+            self.after(MainApp.SAVING_POLL, self.poll_saving_)
+
+    def poll_saving_(self):
+        """
+        completion of background saving is posted back to GUI thread here.
+        """
+        while True:
+            try:
+                ok, jobs = self._saved.get_nowait()
+            except queue.Empty:
+                break
+            self._saving -= 1
+            if ok:
+                for editor, record, copy, fields in jobs:
+                    record.after_saving(fields, copy)
+                continue
+            for editor, record, copy, fields in jobs:
+                if editor.winfo_exists():
+                    editor.on_modified()
+            tkMessageBox.showerror(MainApp.TITLE, 'Failed to save documents.')
+        if self._saving > 0:
+            self.after(MainApp.SAVING_POLL, self.poll_saving_)
+        else:
+            self._status.set('')
+
+    def wait_saving_(self):
+        """
+        block until background saving is finished, e.g., before closing database or
+        deleting a document which may be in saving.
+        """
+        if self._writer is not None:
+            self._writer.wait()
+        self.poll_saving_()
+
+    def stage_(self, editor):
+        """
+        prepare the document of editor for saving: title, tags and content.
+        @return tuple(set of MainApp.SAVE, StatedDoc object, textual dict, binary data)
+        """
         errors = set()
         try:
             record = self._notes[editor]
@@ -1747,20 +1866,7 @@ class MainApp(tk.Tk):
         if len(textual) == 0:
             errors.add(MainApp.SAVE.FailContent)
         #
-        if MainApp.SAVE.FailContent in errors:
-            return errors
-        #
-        # save everything to database
-        record.bulk = binary
-        record.script = json.dumps(textual)
-        if record.fragile:
-            self._store.insert_doc(record)
-            self._notes[editor] = record
-        else:
-            self._store.update_doc(record)
-        editor.on_saved()
-        errors.add(MainApp.SAVE.Finish)
-        return errors
+        return errors, record, textual, binary
 
     def menu_doc_close_(self, evt=None):
         editor = self._editor.active
@@ -1782,9 +1888,10 @@ class MainApp(tk.Tk):
         if not tkMessageBox.askokcancel(MainApp.TITLE, 'Do you really want to delete\n"%s"?' % caption):
             return
         if editor in self._notes:
+            self.wait_saving_()  # a new doc has no sn until it's saved
             note = self._notes.pop(editor)
-            if self._store.delete_doc(note.sn) and note in self._last_search.hits:
-                self._last_search.hits.remove(note)
+            if not note.fragile and self._store.delete_doc(note.sn) and self._last_search is not None:
+                self._last_search.refresh()
         self._editor.remove(editor)
         if self._editor.active is None:
             self.event_generate(MainApp.EVENT_DOC_EXIST, state=0)
@@ -1806,6 +1913,9 @@ At the age of 40.
         self.title(MainApp.TITLE)
         self.protocol('WM_DELETE_WINDOW', self.quit_)
         self._store = None
+        self._writer = None  # saving documents in background
+        self._saved = queue.Queue()  # results of background saving
+        self._saving = 0  # number of unfinished saving jobs
         self._notes = {}  # each editor-tab corresponds to a note object
         self._last_search = None
         self._tip_mgr = TipManager()
@@ -1821,8 +1931,6 @@ At the age of 40.
         self.bind_class('Entry', '<Control-C>', EntryOps.copy)
         self.bind_class('Entry', '<Control-X>', EntryOps.cut)
         self.bind_class('Entry', '<Control-V>', EntryOps.paste)
-        #
-        jdb.DocBase.assign_finder(self.find_words)
 
     def menu_doc_attr_(self):
         editor = self._editor.active
@@ -2124,7 +2232,11 @@ At the age of 40.
         if not jdb.DocBase.validate(database):
             tkMessageBox.showerror(MainApp.TITLE, 'Database format is different!')
             return
-        num = self._store.copy_docs(records, database)
+        def progress(done, total):
+            self._status.set('copying: %d/%d' % (done, total))
+            self.update_idletasks()
+        num = self._store.copy_docs(records, database, progress)
+        self._status.set('')
         quiz = 'records are duplicated to'
         tkMessageBox.showinfo(MainApp.TITLE, '%d %s\n%s.' % (num, quiz, os.path.basename(database)))
 
@@ -2274,8 +2386,8 @@ At the age of 40.
         if len(images) > 0:
             textual["image"] = images
         binary = buf.getvalue()
-        # even if buffer is empty, it still contains magic head bytes
-        if len(binary) == len(jex.FilePile.MAGIC_HEAD):
+        # even if no image, the pile still contains magic head and footer
+        if len(images) == 0:
             binary = b''
         # 3. tables
         tables = []
@@ -2322,8 +2434,7 @@ At the age of 40.
         """
         try:
             core = editor.core()
-            textual, binary = self._store.read_doc(doc.sn)
-            textual = json.loads(textual)
+            textual = json.loads(self._store.read_text(doc.sn))
             text = textual.pop("text", '')
             # 1. text
             core.insert('1.0', text)
@@ -2337,16 +2448,21 @@ At the age of 40.
             core.config(font=font)
             # 2. images
             images = textual.pop('image', [])
+            bulk_md5 = hashlib.md5(b'').digest()  # a document without image has empty bulk
             if len(images) > 0:
-                jfp = jex.FilePile(io.BytesIO(binary))
-                for i in images:
-                    fd = jfp.open(i['name'])
-                    ext = os.path.splitext(i['name'])[1]
-                    image = jtk.ImageBox(core, image=io.BytesIO(fd.read()), scale=i['scale'], ext=ext)
-                    core.delete(i['pos'])  # delete placeholder
-                    core.window_create(i['pos'], window=image)
-                    fd.close()
-                jfp.close()
+                bulk = self._store.open_bulk(doc.sn)  # images are read one by one
+                try:
+                    for i in images:
+                        data = bulk.view(i['name'])
+                        if data is None:
+                            raise RuntimeError('File %s not found' % i['name'])
+                        ext = os.path.splitext(i['name'])[1]
+                        image = jtk.ImageBox(core, image=jex.BufferReader(data), scale=i['scale'], ext=ext)
+                        core.delete(i['pos'])  # delete placeholder
+                        core.window_create(i['pos'], window=image)
+                    bulk_md5 = bulk.md5()
+                finally:
+                    bulk.close()  # an open blob handle blocks writing of DocWriter
             # 3. tables
             for i in textual.pop('table', []):
                 table = jtk.TextTableBox(core, table=i['specs'], font=font)
@@ -2377,25 +2493,13 @@ At the age of 40.
                 self._tip_mgr.insert(core, t['text'], t['start'], t['end'], i)
             #
             # data-loading finished, now initialize digests for big data
-            doc.init_digest(text=text, bulk=binary)
+            doc.init_digest(text=text)
+            doc.set_digest('bulk', bulk_md5)
         except RuntimeError:
             print('bulk data cannot be extracted.')
         except Exception as e:
             print('Error: %s' % e)
 
-    def find_words(self, textual, words):
-        root = json.loads(textual)
-        text = []
-        for t in root.pop('table', []):
-            data = t['specs']
-            text.extend([cell['text'] for row in data for cell in row])
-        for t in root.pop('tip', []):
-            text.append(t['text'])
-        text = '\n'.join(text)
-        if 'text' in root:
-            text = '%s\n%s' % (text, root['text'])
-        return all(i in text.lower() for i in words)  # case-insensitive compare
-
     def on_tab_closed(self, editor: jtk.TextEditor):
         windows = self.all_custom_windows(editor.core(), jtk.ImageBox)
         for w in windows: